@@ -0,0 +1,212 @@
+# ===== Библиотеки =====
+
+import asyncio
+import ipaddress
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse
+
+# ===== Конфигурация =====
+
+# Адреса (или подсети) обратных прокси, которым разрешено передавать X-Real-IP,
+# через запятую. Заголовок от остальных клиентов игнорируется: иначе, подключившись
+# к порту main напрямую, клиент получал бы новый лимит на каждый запрос
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(network.strip(), strict=False)
+    for network in os.getenv("TRUSTED_PROXIES", "").split(",") if network.strip()
+]
+
+# ===== Ограничение параллельности =====
+
+
+class ConcurrencyLimiter:
+    """Ограничение числа одновременных запросов с ограниченной очередью ожидания"""
+
+    def __init__(self, name: str, limit: int, queue_size: int, timeout: float):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(limit)
+
+        # Метрики
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @property
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.timeout))
+
+    def _reject(self, detail: str):
+        self.rejected += 1
+        raise HTTPException(status_code=503, detail=detail,
+                            headers={"Retry-After": str(self.retry_after)})
+
+    @asynccontextmanager
+    async def slot(self):
+        """Занимает слот; при переполненной очереди или таймауте отвечает 503"""
+        if self.active + self.waiting >= self.limit + self.queue_size:
+            self._reject("Сервер перегружен, попробуйте позже")
+
+        self.waiting += 1
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self._reject("Превышено время ожидания в очереди")
+        finally:
+            self.waiting -= 1
+
+        waited = time.monotonic() - started
+        self.admitted += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+
+    def metrics(self) -> dict:
+        return {
+            "limit": self.limit,
+            "queue_size": self.queue_size,
+            "active": self.active,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "wait_avg": self.wait_total / self.admitted if self.admitted else 0.0,
+            "wait_max": self.wait_max,
+        }
+
+
+# ===== Ограничение частоты =====
+
+
+class RateLimiter:
+    """Token bucket по ключу клиента (пользователь или IP)"""
+
+    def __init__(self, name: str, rate: float, burst: int, max_keys: int = 10000):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self.rejected = 0
+
+    def _refill(self, key: str, now: float) -> float:
+        tokens, last = self._buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - last) * self.rate)
+
+    def check(self, key: str):
+        """Списывает токен или отвечает 429 с Retry-After"""
+        now = time.monotonic()
+        tokens = self._refill(key, now)
+        if tokens < 1:
+            self.rejected += 1
+            retry_after = max(1, math.ceil((1 - tokens) / self.rate))
+            raise HTTPException(status_code=429, detail="Слишком много запросов",
+                                headers={"Retry-After": str(retry_after)})
+        self._buckets[key] = (tokens - 1, now)
+
+        if len(self._buckets) > self.max_keys:
+            self._prune(now)
+
+    def _prune(self, now: float):
+        """Удаляет полностью восстановившиеся корзины"""
+        for key in [key for key in self._buckets if self._refill(key, now) >= self.burst]:
+            del self._buckets[key]
+
+    def metrics(self) -> dict:
+        return {"rate": self.rate, "burst": self.burst,
+                "clients": len(self._buckets), "rejected": self.rejected}
+
+
+# ===== Ключи клиентов =====
+
+
+def is_trusted_proxy(host: str) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_PROXIES)
+
+
+def ip_key(request: Request) -> str:
+    """Ключ клиента по IP (за доверенным прокси — из X-Real-IP)"""
+    ip = request.client.host if request.client else "unknown"
+    real_ip = request.headers.get("x-real-ip")
+    if real_ip and is_trusted_proxy(ip):
+        ip = real_ip
+    return f"ip:{ip}"
+
+
+def user_key(request: Request) -> str:
+    """
+    Ключ по пользователю, если cookie user_id подтверждена подписанной сессией;
+    иначе по IP (cookie задаёт сам клиент и может менять её на каждый запрос).
+    """
+    user_id = request.cookies.get("user_id")
+    session = request.scope.get("session") or {}
+    if user_id and str(session.get("user_id")) == user_id:
+        return f"user:{user_id}"
+    return ip_key(request)
+
+
+# ===== ASGI middleware =====
+
+
+class AdmissionRule:
+    """Ограничения эндпоинта: очередь, rate limit и способ определения клиента"""
+
+    def __init__(self, limiter: ConcurrencyLimiter, rate_limiter: Optional[RateLimiter] = None,
+                 key: Callable[[Request], str] = ip_key):
+        self.limiter = limiter
+        self.rate_limiter = rate_limiter
+        self.key = key
+
+
+class AdmissionMiddleware:
+    """
+    Допуск к дорогим эндпоинтам до чтения тела запроса:
+    при отказе клиент сразу получает 429/503, загрузка файла не принимается.
+    """
+
+    def __init__(self, app, rules: Dict[Tuple[str, str], AdmissionRule]):
+        self.app = app
+        self.rules = rules
+
+    async def __call__(self, scope, receive, send):
+        rule = self.rules.get((scope.get("method"), scope.get("path"))) \
+            if scope["type"] == "http" else None
+        if rule is None:
+            await self.app(scope, receive, send)
+            return
+
+        slot = rule.limiter.slot()
+        try:
+            if rule.rate_limiter is not None:
+                rule.rate_limiter.check(rule.key(Request(scope)))
+            await slot.__aenter__()
+        except HTTPException as e:
+            response = JSONResponse(status_code=e.status_code,
+                                    content={"error": e.detail}, headers=e.headers)
+            await response(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await slot.__aexit__(None, None, None)
@@ -0,0 +1,8 @@
+import os
+import tempfile
+
+# Тесты сервисов работают с отдельной временной БД и папкой загрузок.
+# Переменные задаются до импорта database/main (load_dotenv их не перезаписывает).
+_TEST_DATA_DIR = tempfile.mkdtemp(prefix="meowlib-test-")
+os.environ.setdefault("DB_DIRECTORY", _TEST_DATA_DIR)
+os.environ.setdefault("UPLOAD_DIR", os.path.join(_TEST_DATA_DIR, "uploads"))
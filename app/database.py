@@ -1,13 +1,19 @@
 # ===== Библиотеки =====
 
 from contextlib import asynccontextmanager
+import asyncio
 import os
 import bcrypt
 import logging
+from datetime import datetime, timezone
 from typing import Optional, List
 
-from fastapi import FastAPI, HTTPException, Body, Depends, Path
+from fastapi import FastAPI, HTTPException, Body, Depends, Path, Query, Request
+from fastapi.responses import JSONResponse, Response
 from sqlmodel import Field, Relationship, SQLModel, select
+from sqlalchemy import Index, UniqueConstraint, delete
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from typing import AsyncGenerator
@@ -15,6 +21,21 @@ from typing import AsyncGenerator
 from dotenv import load_dotenv
 import pathlib
 
+from migrations import run_migrations
+from progress import ProgressBuffer
+from profiling import RequestProfiler
+
+# Быстрая сериализация (необязательные зависимости)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 # ===== Конфигурация =====
 
 # Логирование
@@ -43,10 +64,38 @@ engine = create_async_engine(DB_URL, echo=False, future=True)
 async_session = sessionmaker(
     engine, expire_on_commit=False, class_=AsyncSession)
 
+# Токен доверенных внутренних запросов (от сервиса main)
+INTERNAL_TOKEN = os.getenv("INTERNAL_TOKEN", "")
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+# Ограничение на размер пакетных запросов
+BATCH_LIMIT = int(os.getenv("BATCH_LIMIT", 500))
+
+# Буфер прогресса чтения: интервал сброса (сек) и порог досрочного сброса
+PROGRESS_FLUSH_INTERVAL = float(os.getenv("PROGRESS_FLUSH_INTERVAL", 5))
+PROGRESS_MAX_PENDING = int(os.getenv("PROGRESS_MAX_PENDING", 1000))
+PROGRESS_CHUNK_SIZE = 150
+
+# Лента изменений: размер страницы и максимальное время long-poll (сек)
+CHANGES_LIMIT = int(os.getenv("CHANGES_LIMIT", 500))
+CHANGES_MAX_WAIT = float(os.getenv("CHANGES_MAX_WAIT", 30))
+
 
 # ===== Определение моделей =====
 
 
+def utc_now() -> datetime:
+    """Текущее время в UTC (sqlmodel принимает только datetime с часовым поясом)"""
+    return datetime.now(timezone.utc)
+
+
+def as_utc(value: datetime) -> datetime:
+    """Приводит datetime к UTC (SQLite без поддержки часовых поясов может вернуть naive)"""
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
 class UserBase(SQLModel):
     """Базовая модель пользователя"""
     username: str = Field(index=True, unique=True)
@@ -77,6 +126,8 @@ class BookBase(SQLModel):
     description: Optional[str]
     file_path: str
     cover_path: Optional[str]
+    # CRC-32 файла, считается при загрузке (нужен для экспорта в ZIP)
+    file_crc: Optional[int] = None
 
 
 class BookCreate(BookBase):
@@ -90,6 +141,10 @@ class BookRead(BookBase):
     user_id: int
 
 
+# Поля ответа о книге; вычисляются один раз (обращение к __fields__ устарело и медленное)
+BOOK_READ_FIELDS = tuple(BookRead.model_fields)
+
+
 class BookUpdate(SQLModel):
     """Модель для обновления книги"""
     title: Optional[str] = None
@@ -97,16 +152,136 @@ class BookUpdate(SQLModel):
     description: Optional[str] = None
     file_path: Optional[str] = None
     cover_path: Optional[str] = None
+    file_crc: Optional[int] = None
     user_id: Optional[int] = None
 
 
+class BookBulkUpdate(BookUpdate):
+    """Модель для пакетного обновления книги"""
+    id: int
+
+
 class Book(BookBase, table=True):
     """Модель книги в БД"""
+    __table_args__ = (
+        # Покрывает выборку по user_id и сортировку по названию
+        Index("ix_book_user_id_title", "user_id", "title"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: Optional[int] = Field(default=None, foreign_key="user.id")
     user: Optional[User] = Relationship(back_populates="books")
 
 
+class ReadingProgressBase(SQLModel):
+    """Базовая модель прогресса чтения"""
+    locator: str
+    percent: float = Field(ge=0, le=100)
+
+
+class ReadingProgressUpdate(ReadingProgressBase):
+    """Модель для отчёта о позиции чтения"""
+    user_id: int
+    book_id: int
+
+
+class ReadingProgressRead(ReadingProgressUpdate):
+    """Модель для чтения прогресса"""
+    updated_at: datetime
+
+
+class ReadingProgress(ReadingProgressBase, table=True):
+    """Модель прогресса чтения в БД"""
+    __table_args__ = (
+        UniqueConstraint("user_id", "book_id", name="uq_progress_user_book"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user_id: int = Field(foreign_key="user.id")
+    book_id: int = Field(foreign_key="book.id")
+    updated_at: datetime
+
+
+class BookChange(SQLModel, table=True):
+    """Запись ленты изменений книг (для удалений — надгробие)"""
+    __table_args__ = (
+        Index("ix_bookchange_user_id_seq", "user_id", "seq"),
+        # Номера изменений никогда не переиспользуются
+        {"sqlite_autoincrement": True},
+    )
+
+    seq: Optional[int] = Field(default=None, primary_key=True)
+    book_id: int
+    user_id: Optional[int] = None
+    op: str
+    created_at: datetime = Field(default_factory=utc_now)
+
+
+class ChangeRead(SQLModel):
+    """Модель изменения книги (book пуст для удалённых книг)"""
+    seq: int
+    op: str
+    book_id: int
+    book: Optional[BookRead] = None
+
+
+class ChangesRead(SQLModel):
+    """Модель страницы ленты изменений"""
+    cursor: int
+    changes: List[ChangeRead]
+
+
+# ===== Запросы =====
+# Горячие запросы собираются здесь: эндпоинты и проверка планов
+# (python migrations.py --check) используют одни и те же выражения
+
+
+def user_by_username_query(username: str):
+    return select(User).where(User.username == username)
+
+
+def books_query(user_id: Optional[int] = None):
+    query = select(Book)
+    if user_id is not None:
+        query = query.where(Book.user_id == user_id).order_by(Book.title)
+    return query
+
+
+def books_by_ids_query(book_ids: List[int]):
+    return select(Book).where(Book.id.in_(book_ids))
+
+
+def changes_query(since: int, user_id: Optional[int] = None, limit: int = CHANGES_LIMIT):
+    query = select(BookChange).where(BookChange.seq > since)
+    if user_id is not None:
+        query = query.where(BookChange.user_id == user_id)
+    return query.order_by(BookChange.seq).limit(limit)
+
+
+def progress_query(user_id: int, book_id: Optional[int] = None):
+    query = select(ReadingProgress).where(ReadingProgress.user_id == user_id)
+    if book_id is not None:
+        query = query.where(ReadingProgress.book_id == book_id)
+    return query
+
+
+def hot_queries() -> dict:
+    """SQL горячих запросов с подставленными значениями (для EXPLAIN QUERY PLAN)"""
+    queries = {
+        "authenticate_user(username)": user_by_username_query("meow"),
+        "read_books(user_id)": books_query(1),
+        "read_books_batch(ids)": books_by_ids_query([1, 2, 3]),
+        "read_changes(since)": changes_query(1),
+        "read_changes(user_id, since)": changes_query(1, user_id=1),
+        "read_progress(user_id)": progress_query(1),
+        "read_progress(user_id, book_id)": progress_query(1, book_id=1),
+    }
+    return {
+        name: str(query.compile(dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True}))
+        for name, query in queries.items()
+    }
+
+
 # ===== Управление БД =====
 
 async def create_db_and_tables():
@@ -114,6 +289,7 @@ async def create_db_and_tables():
     try:
         async with engine.begin() as conn:
             await conn.run_sync(SQLModel.metadata.create_all)
+            await conn.run_sync(run_migrations)
         logging.info("✅ Таблицы успешно созданы!")
     except Exception as e:
         logging.error(f"❌ Ошибка при создании таблиц: {str(e)}")
@@ -126,6 +302,70 @@ async def get_session() -> AsyncGenerator[AsyncSession, None]:
         yield session
 
 
+async def write_progress(records: List[dict]):
+    """Пакетный upsert прогресса чтения (более старые позиции не затирают новые)"""
+    table = ReadingProgress.__table__
+    async with engine.begin() as conn:
+        # Книга могла быть удалена, пока отчёт ждал в буфере: SQLite не проверяет
+        # внешний ключ, поэтому такие записи отбрасываем сами
+        book_ids = {record["book_id"] for record in records}
+        result = await conn.execute(select(Book.id).where(Book.id.in_(book_ids)))
+        existing = set(result.scalars().all())
+        records = [record for record in records if record["book_id"] in existing]
+        # Порциями, чтобы не упереться в лимит параметров SQLite
+        for start in range(0, len(records), PROGRESS_CHUNK_SIZE):
+            statement = sqlite_insert(table).values(
+                records[start:start + PROGRESS_CHUNK_SIZE])
+            statement = statement.on_conflict_do_update(
+                index_elements=["user_id", "book_id"],
+                set_={
+                    "locator": statement.excluded.locator,
+                    "percent": statement.excluded.percent,
+                    "updated_at": statement.excluded.updated_at,
+                },
+                where=table.c.updated_at < statement.excluded.updated_at,
+            )
+            await conn.execute(statement)
+
+
+progress_buffer = ProgressBuffer(
+    write_progress, PROGRESS_FLUSH_INTERVAL, PROGRESS_MAX_PENDING)
+
+
+# ===== Лента изменений =====
+
+# Событие пересоздаётся после каждого уведомления, ожидающие long-poll
+# запросы держат ссылку на своё событие
+changes_event = asyncio.Event()
+
+
+def record_change(session: AsyncSession, op: str, book_id: int, user_id: Optional[int]):
+    """Добавляет запись в ленту изменений в текущей транзакции"""
+    session.add(BookChange(book_id=book_id, user_id=user_id, op=op))
+
+
+def apply_book_update(session: AsyncSession, db_book: Book, update_data: dict):
+    """Применяет обновление к книге и пишет его в ленту изменений"""
+    old_user_id = db_book.user_id
+    for key, value in update_data.items():
+        setattr(db_book, key, value)
+    session.add(db_book)
+
+    if db_book.user_id != old_user_id:
+        # Книга сменила владельца: для прежнего владельца она удалена
+        record_change(session, "delete", db_book.id, old_user_id)
+        record_change(session, "create", db_book.id, db_book.user_id)
+    else:
+        record_change(session, "update", db_book.id, db_book.user_id)
+
+
+def notify_changes():
+    """Будит ожидающих long-poll клиентов после коммита"""
+    global changes_event
+    changes_event.set()
+    changes_event = asyncio.Event()
+
+
 # ===== Хеширование паролей =====
 
 
@@ -141,6 +381,43 @@ def verify_password(password: str, hashed_password: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
 
 
+# ===== Сериализация =====
+
+
+def is_trusted_request(request: Request) -> bool:
+    """Проверяет, что запрос пришёл от доверенного внутреннего сервиса"""
+    return bool(INTERNAL_TOKEN) and request.headers.get("x-internal-token") == INTERNAL_TOKEN
+
+
+def book_to_dict(book: Book) -> dict:
+    """Преобразует книгу из БД в словарь без повторной валидации"""
+    return {name: getattr(book, name) for name in BOOK_READ_FIELDS}
+
+
+def encode_response(request: Request, payload) -> Response:
+    """Кодирует ответ в msgpack (по заголовку Accept), orjson или stdlib JSON"""
+    if msgpack is not None and MSGPACK_MEDIA_TYPE in request.headers.get("accept", ""):
+        return Response(content=msgpack.packb(payload, use_bin_type=True), media_type=MSGPACK_MEDIA_TYPE)
+    if orjson is not None:
+        return Response(content=orjson.dumps(payload), media_type="application/json")
+    return JSONResponse(content=payload)
+
+
+def books_response(request: Request, books):
+    """Ответ со списком книг: быстрый путь для внутренних запросов,
+    обычная валидация через response_model для остальных"""
+    if is_trusted_request(request):
+        return encode_response(request, [book_to_dict(book) for book in books])
+    return books
+
+
+def book_response(request: Request, book: Book):
+    """Ответ с одной книгой (см. books_response)"""
+    if is_trusted_request(request):
+        return encode_response(request, book_to_dict(book))
+    return book
+
+
 # ===== FastAPI =====
 
 
@@ -148,11 +425,16 @@ def verify_password(password: str, hashed_password: str) -> bool:
 async def lifespan(app: FastAPI):
     """Запуск FastAPI с инициализацией БД"""
     await create_db_and_tables()
+    progress_buffer.start()
     yield
+    await progress_buffer.stop()
 
 
 app = FastAPI(lifespan=lifespan)
 
+# Профилирование запросов (включается через PROFILE_TOKEN / PROFILE_SAMPLE_RATE)
+RequestProfiler("database").install(app, engine.sync_engine)
+
 
 # ===== Маршруты =====
 
@@ -160,12 +442,13 @@ app = FastAPI(lifespan=lifespan)
 @app.post("/users/", response_model=UserRead)
 async def create_user(user: UserCreate, session: AsyncSession = Depends(get_session)):
     """Создание нового пользователя"""
-    existing_user = await session.execute(select(User).where(User.username == user.username))
+    existing_user = await session.execute(user_by_username_query(user.username))
     if existing_user.scalars().first():
         raise HTTPException(
             status_code=400, detail="Пользователь уже зарегистрирован")
 
-    hashed_password = hash_password(user.password)
+    # bcrypt нагружает CPU, поэтому выполняется вне цикла событий
+    hashed_password = await asyncio.to_thread(hash_password, user.password)
     new_user = User(username=user.username, email=user.email,
                     password_hash=hashed_password)
 
@@ -179,10 +462,10 @@ async def create_user(user: UserCreate, session: AsyncSession = Depends(get_sess
 @app.post("/users/authenticate/")
 async def authenticate_user(username: str = Body(...), password: str = Body(...), session: AsyncSession = Depends(get_session)):
     """Аутентификация пользователя"""
-    query = await session.execute(select(User).where(User.username == username))
+    query = await session.execute(user_by_username_query(username))
     db_user = query.scalars().first()
 
-    if not db_user or not verify_password(password, db_user.password_hash):
+    if not db_user or not await asyncio.to_thread(verify_password, password, db_user.password_hash):
         raise HTTPException(
             status_code=401, detail="Неверный логин или пароль")
 
@@ -208,34 +491,85 @@ async def create_book(book: BookCreate, session: AsyncSession = Depends(get_sess
     new_book = Book(**book.dict())
 
     session.add(new_book)
+    await session.flush()
+    record_change(session, "create", new_book.id, new_book.user_id)
     await session.commit()
+    notify_changes()
     await session.refresh(new_book)
     return new_book
 
 
 @app.get("/books/", response_model=List[BookRead])
-async def read_books(user_id: Optional[int] = None, session: AsyncSession = Depends(get_session)):
+async def read_books(request: Request, user_id: Optional[int] = None, session: AsyncSession = Depends(get_session)):
     """Получение списка книг (по пользователю или всех)"""
-    query = select(Book)
-    if user_id is not None:
-        query = query.where(Book.user_id == user_id)
-
-    result = await session.execute(query)
+    result = await session.execute(books_query(user_id))
     books = result.scalars().all()
-    return books
+    return books_response(request, books)
+
+
+@app.patch("/books/", response_model=List[BookRead])
+async def update_books(
+    request: Request,
+    books: List[BookBulkUpdate] = Body(...),
+    session: AsyncSession = Depends(get_session)
+):
+    """Пакетное обновление книг одной транзакцией"""
+    if len(books) > BATCH_LIMIT:
+        raise HTTPException(
+            status_code=400, detail=f"Не более {BATCH_LIMIT} книг за запрос")
+
+    ids = [book.id for book in books]
+    result = await session.execute(books_by_ids_query(ids))
+    db_books = {book.id: book for book in result.scalars().all()}
+
+    missing = [book_id for book_id in ids if book_id not in db_books]
+    if missing:
+        raise HTTPException(
+            status_code=404, detail=f"Книги не найдены: {missing}")
+
+    for book in books:
+        db_book = db_books[book.id]
+        apply_book_update(session, db_book, book.dict(
+            exclude_unset=True, exclude={"id"}))
+
+    await session.commit()
+    notify_changes()
+    return books_response(request, [db_books[book_id] for book_id in ids])
+
+
+@app.get("/books/batch/", response_model=List[BookRead])
+async def read_books_batch(
+    request: Request,
+    ids: str = Query(..., description="ID книг через запятую"),
+    session: AsyncSession = Depends(get_session)
+):
+    """Получение нескольких книг одним запросом (порядок как в ids)"""
+    try:
+        book_ids = [int(book_id) for book_id in ids.split(",") if book_id.strip()]
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Некорректный список ID")
+    if len(book_ids) > BATCH_LIMIT:
+        raise HTTPException(
+            status_code=400, detail=f"Не более {BATCH_LIMIT} книг за запрос")
+
+    result = await session.execute(books_by_ids_query(book_ids))
+    found = {book.id: book for book in result.scalars().all()}
+    books = [found[book_id] for book_id in dict.fromkeys(book_ids) if book_id in found]
+    return books_response(request, books)
 
 
 @app.get("/books/{book_id}/", response_model=BookRead)
-async def read_book(book_id: int, session: AsyncSession = Depends(get_session)):
+async def read_book(request: Request, book_id: int, session: AsyncSession = Depends(get_session)):
     """Получение информации о книге"""
     book = await session.get(Book, book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Книга не найдена")
-    return book
+    return book_response(request, book)
 
 
 @app.patch("/books/{book_id}/", response_model=BookRead)
 async def update_book(
+    request: Request,
     book_id: int = Path(title="ID книги"),  # Убрали `...`
     book: BookUpdate = Body(...),
     session: AsyncSession = Depends(get_session)
@@ -245,12 +579,115 @@ async def update_book(
     if not db_book:
         raise HTTPException(status_code=404, detail="Книга не найдена")
 
-    update_data = book.dict(exclude_unset=True)
-    for key, value in update_data.items():
-        setattr(db_book, key, value)
-
-    session.add(db_book)
+    apply_book_update(session, db_book, book.dict(exclude_unset=True))
     await session.commit()
+    notify_changes()
     await session.refresh(db_book)
 
-    return db_book
+    return book_response(request, db_book)
+
+
+@app.delete("/books/{book_id}/")
+async def delete_book(book_id: int, session: AsyncSession = Depends(get_session)):
+    """Удаление книги (в ленте изменений остаётся надгробие)"""
+    db_book = await session.get(Book, book_id)
+    if not db_book:
+        raise HTTPException(status_code=404, detail="Книга не найдена")
+
+    record_change(session, "delete", db_book.id, db_book.user_id)
+    await session.execute(delete(ReadingProgress).where(ReadingProgress.book_id == book_id))
+    await session.delete(db_book)
+    await session.commit()
+    progress_buffer.discard_book(book_id)
+    notify_changes()
+
+    return {"message": "Книга удалена", "book_id": book_id}
+
+
+@app.get("/changes/", response_model=ChangesRead)
+async def read_changes(
+    request: Request,
+    since: int = Query(0, ge=0, description="Курсор: seq последнего полученного изменения"),
+    user_id: Optional[int] = None,
+    wait: float = Query(0, ge=0, description="Long-poll: сколько секунд ждать новых изменений"),
+    limit: int = Query(CHANGES_LIMIT, ge=1, le=CHANGES_LIMIT),
+    session: AsyncSession = Depends(get_session)
+):
+    """Изменения книг после курсора since (по пользователю или всех)"""
+    query = changes_query(since, user_id, limit)
+
+    event = changes_event
+    changes = (await session.execute(query)).scalars().all()
+    if not changes and wait:
+        # Отпускаем соединение на время ожидания, чтобы не держать пул и снимок БД
+        await session.rollback()
+        try:
+            await asyncio.wait_for(event.wait(), min(wait, CHANGES_MAX_WAIT))
+        except asyncio.TimeoutError:
+            pass
+        else:
+            changes = (await session.execute(query)).scalars().all()
+
+    # Для каждой книги достаточно последнего изменения на странице
+    latest = {change.book_id: change for change in changes}
+    alive_ids = [book_id for book_id, change in latest.items() if change.op != "delete"]
+    books = {}
+    if alive_ids:
+        result = await session.execute(books_by_ids_query(alive_ids))
+        books = {
+            book.id: book_to_dict(book) for book in result.scalars().all()
+            # Книга могла с тех пор перейти к другому владельцу: её текущие данные
+            # не отдаём прежнему, а старое изменение превращаем в надгробие
+            if user_id is None or book.user_id == user_id
+        }
+
+    payload = {
+        "cursor": changes[-1].seq if changes else since,
+        "changes": [
+            {"seq": change.seq,
+             "op": change.op if change.book_id in books else "delete",
+             "book_id": change.book_id,
+             "book": books.get(change.book_id)}
+            for change in sorted(latest.values(), key=lambda change: change.seq)
+        ],
+    }
+    if is_trusted_request(request):
+        return encode_response(request, payload)
+    return payload
+
+
+@app.put("/progress/", response_model=ReadingProgressRead, status_code=202)
+async def report_progress(progress: ReadingProgressUpdate, session: AsyncSession = Depends(get_session)):
+    """Отчёт о позиции чтения (запись в БД откладывается и сворачивается)"""
+    book = await session.get(Book, progress.book_id)
+    if not book:
+        raise HTTPException(status_code=404, detail="Книга не найдена")
+    if book.user_id != progress.user_id:
+        raise HTTPException(status_code=403, detail="Книга принадлежит другому пользователю")
+
+    record = progress.dict()
+    record["updated_at"] = utc_now()
+    return progress_buffer.put(record)
+
+
+@app.get("/progress/", response_model=List[ReadingProgressRead])
+async def read_progress(user_id: int, book_id: Optional[int] = None, session: AsyncSession = Depends(get_session)):
+    """Прогресс чтения пользователя с учётом ещё не записанных позиций"""
+    result = await session.execute(progress_query(user_id, book_id))
+    records = {
+        row.book_id: ReadingProgressRead(**row.dict()).dict()
+        for row in result.scalars().all()
+    }
+    for record in progress_buffer.pending_for_user(user_id):
+        if book_id is not None and record["book_id"] != book_id:
+            continue
+        current = records.get(record["book_id"])
+        if current is None or record["updated_at"] >= as_utc(current["updated_at"]):
+            records[record["book_id"]] = record
+    return list(records.values())
+
+
+@app.get("/progress/metrics/")
+async def progress_metrics():
+    """Метрики буфера прогресса чтения"""
+    return progress_buffer.metrics()
@@ -5,18 +5,22 @@ from pathlib import Path
 import aiofiles
 import asyncio  # Работа с асинхронностью
 import time  # Работа с временем
+import json  # Манифест экспорта
+import re  # Очистка имён файлов
+import zlib  # CRC-32 загруженных файлов
 import os  # Работа с файлами
 import logging  # Работа с логами
 import redis  # Работа с Redis
 
 # Библиотеки для работы с FastAPI
-from fastapi import FastAPI, HTTPException, Request, Form, UploadFile  # FastAPI
+from fastapi import FastAPI, HTTPException, Request, Form, UploadFile, Body  # FastAPI
 # HTML ответы и редиректы
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, FileResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates  # Jinja2 шаблонизатор
 from fastapi.staticfiles import StaticFiles  # Статические файлы (CSS, JS)
 from starlette.middleware.sessions import SessionMiddleware  # Работа с сессиями
 from pathlib import Path  # Работа с путями
+from urllib.parse import quote  # Экранирование путей в URL
 from dotenv import load_dotenv  # Загрузка переменных окружения
 
 # Библиотеки для работы с книгами
@@ -24,6 +28,27 @@ from ebooklib import epub  # Работа с EPUB-книгами
 from pdf2image import convert_from_path  # Работа с PDF-книгами
 import httpx  # Работа с HTTP-запросами
 
+# Ограничение нагрузки на дорогие эндпоинты
+from admission import (AdmissionMiddleware, AdmissionRule, ConcurrencyLimiter,
+                       RateLimiter, ip_key, user_key)
+
+# Профилирование отдельных запросов
+from profiling import RequestProfiler, downstream_headers, record_downstream
+
+# Потоковый экспорт библиотеки в ZIP
+from zipstream import ZipEntry, ZipStream, parse_byte_range
+
+# Быстрая десериализация ответов БД (необязательные зависимости)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 # ===== Конфигурация =====
 
 
@@ -52,6 +77,27 @@ DB_URL = os.getenv("DB_URL", f"sqlite:///{DB_DIRECTORY}/{DB_FILE}")
 DB_DOCKER_URL = f"http://database:{DB_SERVER_PORT}"
 MAIN_DOCKER_URL = f"http://main:{MAIN_PORT}"
 
+# Токен для доверенных запросов к сервису БД (включает быстрый путь сериализации)
+INTERNAL_TOKEN = os.getenv("INTERNAL_TOKEN", "")
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+# Отдача файлов через nginx (X-Accel-Redirect): включать только за nginx
+DOWNLOAD_ACCEL = os.getenv("DOWNLOAD_ACCEL", "false").lower() in ("1", "true", "yes")
+ACCEL_REDIRECT_PREFIX = os.getenv("ACCEL_REDIRECT_PREFIX", "/protected/uploads/")
+
+# Ограничение нагрузки: параллельность, размер очереди, таймаут ожидания
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", 2))
+UPLOAD_QUEUE_SIZE = int(os.getenv("UPLOAD_QUEUE_SIZE", 8))
+AUTH_CONCURRENCY = int(os.getenv("AUTH_CONCURRENCY", 4))
+AUTH_QUEUE_SIZE = int(os.getenv("AUTH_QUEUE_SIZE", 16))
+QUEUE_TIMEOUT = float(os.getenv("QUEUE_TIMEOUT", 5))
+
+# Ограничение частоты: запросов в секунду и размер всплеска на клиента
+UPLOAD_RATE = float(os.getenv("UPLOAD_RATE", 0.2))
+UPLOAD_BURST = int(os.getenv("UPLOAD_BURST", 3))
+AUTH_RATE = float(os.getenv("AUTH_RATE", 0.5))
+AUTH_BURST = int(os.getenv("AUTH_BURST", 5))
+
 # Инициализация папок
 for directory in [DB_DIRECTORY, UPLOAD_DIR]:
     directory.mkdir(parents=True, exist_ok=True)
@@ -59,9 +105,28 @@ for directory in [DB_DIRECTORY, UPLOAD_DIR]:
 # Инициализация FastAPI
 app = FastAPI()
 
+# Лимитеры дорогих эндпоинтов (загрузка книг, вход и регистрация)
+upload_limiter = ConcurrencyLimiter(
+    "upload", UPLOAD_CONCURRENCY, UPLOAD_QUEUE_SIZE, QUEUE_TIMEOUT)
+auth_limiter = ConcurrencyLimiter(
+    "auth", AUTH_CONCURRENCY, AUTH_QUEUE_SIZE, QUEUE_TIMEOUT)
+upload_rate_limiter = RateLimiter("upload", UPLOAD_RATE, UPLOAD_BURST)
+auth_rate_limiter = RateLimiter("auth", AUTH_RATE, AUTH_BURST)
+auth_rule = AdmissionRule(auth_limiter, auth_rate_limiter, key=ip_key)
+
 # Инициализация middleware
+# Допуск проверяется до чтения тела запроса; добавляется раньше сессий,
+# чтобы выполняться внутри SessionMiddleware и видеть подписанную сессию
+app.add_middleware(AdmissionMiddleware, rules={
+    ("POST", "/add_book"): AdmissionRule(upload_limiter, upload_rate_limiter, key=user_key),
+    ("POST", "/login"): auth_rule,
+    ("POST", "/registration"): auth_rule,
+})
 app.add_middleware(SessionMiddleware, secret_key=SECRET_KEY)
 
+# Профилирование запросов (включается через PROFILE_TOKEN / PROFILE_SAMPLE_RATE)
+RequestProfiler("main").install(app)
+
 # Инициализация шаблонизатора
 templates = Jinja2Templates(directory=BASE_DIR / "templates")
 app.mount("/static", StaticFiles(directory=BASE_DIR / "static"), name="static")
@@ -73,7 +138,7 @@ app.mount("/static", StaticFiles(directory=BASE_DIR / "static"), name="static")
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
     '''Обработчик ошибок HTTP'''
-    return JSONResponse(status_code=exc.status_code, content={"error": exc.detail})
+    return JSONResponse(status_code=exc.status_code, content={"error": exc.detail}, headers=exc.headers)
 
 
 @app.exception_handler(Exception)
@@ -83,12 +148,34 @@ async def general_exception_handler(request: Request, exc: Exception):
     return JSONResponse(status_code=500, content={"error": "Server error"})
 
 
+def internal_headers() -> dict:
+    """Заголовки для внутренних запросов к сервису БД"""
+    headers = {}
+    if INTERNAL_TOKEN:
+        headers["X-Internal-Token"] = INTERNAL_TOKEN
+        if msgpack is not None:
+            headers["Accept"] = f"{MSGPACK_MEDIA_TYPE}, application/json"
+    return headers
+
+
+def decode_response(response: httpx.Response):
+    """Разбор ответа сервиса БД: msgpack, orjson или stdlib JSON"""
+    content_type = response.headers.get("content-type", "")
+    if msgpack is not None and content_type.startswith(MSGPACK_MEDIA_TYPE):
+        return msgpack.unpackb(response.content, raw=False)
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
 async def make_request(method: str, url: str, **kwargs):
     """Функция для выполнения HTTP-запросов с повторными попытками"""
+    kwargs["headers"] = {**internal_headers(), **downstream_headers(), **kwargs.get("headers", {})}
     for _ in range(3):
         try:
             async with httpx.AsyncClient() as client:
                 response = await client.request(method, url, **kwargs)
+                record_downstream(response)
                 response.raise_for_status()
                 return response
         except httpx.RequestError as e:
@@ -154,12 +241,14 @@ async def login_post(request: Request, login: str = Form(...), password: str = F
             f"{DB_DOCKER_URL}/users/authenticate/",
             json={"username": login, "password": password}
         )
-        response_data = response.json()
+        response_data = decode_response(response)
         redirect_response = RedirectResponse(url="/", status_code=303)
         redirect_response.set_cookie(key="user_id", value=str(
             response_data.get("user_id")), httponly=True)
         redirect_response.set_cookie(
             key="username", value=response_data.get("username"), httponly=True)
+        # Подписанная копия user_id: подтверждает cookie для ограничения частоты
+        request.session["user_id"] = response_data.get("user_id")
         return redirect_response
     except HTTPException as e:
         return templates.TemplateResponse("login.html", {
@@ -197,7 +286,7 @@ async def index(request: Request):
 
     try:
         response = await make_request("GET", f"{DB_DOCKER_URL}/books/?user_id={user_id}")
-        books = response.json()
+        books = decode_response(response)
     except HTTPException:
         books = []
 
@@ -206,11 +295,21 @@ async def index(request: Request):
     })
 
 
+@app.get("/metrics/admission")
+async def admission_metrics():
+    """Метрики очередей и ограничений дорогих эндпоинтов"""
+    return {
+        "concurrency": {limiter.name: limiter.metrics() for limiter in (upload_limiter, auth_limiter)},
+        "rate": {limiter.name: limiter.metrics() for limiter in (upload_rate_limiter, auth_rate_limiter)},
+    }
+
+
 @app.get("/logout")
 async def logout(request: Request):
     response = RedirectResponse(url="/", status_code=303)
     response.delete_cookie("username")
     response.delete_cookie("user_id")
+    request.session.clear()
     return response
 
 
@@ -249,8 +348,10 @@ async def add_book_post(
         book_path = UPLOAD_DIR / filename
 
         # Асинхронное сохранение файла
+        content = await book_file.read()
         async with aiofiles.open(book_path, "wb") as f:
-            await f.write(await book_file.read())
+            await f.write(content)
+        file_crc = await asyncio.to_thread(zlib.crc32, content)
 
         # Генерация обложки
         cover_path = await generate_cover_image(str(book_path), user_id)
@@ -262,6 +363,7 @@ async def add_book_post(
             "description": description,
             "file_path": str(book_path),
             "cover_path": cover_path,
+            "file_crc": file_crc,
             "user_id": user_id
         })
         response.raise_for_status()
@@ -280,7 +382,7 @@ async def add_book_post(
 @app.get("/book/{book_id}", response_class=HTMLResponse)
 async def book_details(request: Request, book_id: int):
     response = await make_request("GET", f"{DB_DOCKER_URL}/books/{book_id}/")
-    book = response.json()
+    book = decode_response(response)
     user_login = request.cookies.get("username")
     return templates.TemplateResponse("book.html", {
         "request": request,
@@ -288,14 +390,39 @@ async def book_details(request: Request, book_id: int):
         "user_login": user_login})
 
 
+def accel_redirect_response(file_path: str):
+    """
+    Ответ с X-Accel-Redirect: файл отдаёт nginx (sendfile, Range).
+    Возвращает None, если файл лежит вне UPLOAD_DIR.
+    """
+    try:
+        relative_path = Path(file_path).resolve().relative_to(UPLOAD_DIR.resolve())
+    except ValueError:
+        return None
+    filename = os.path.basename(file_path)
+    return Response(media_type="application/octet-stream", headers={
+        "X-Accel-Redirect": ACCEL_REDIRECT_PREFIX + quote(relative_path.as_posix()),
+        "Content-Disposition": f"attachment; filename*=utf-8''{quote(filename)}",
+    })
+
+
 @app.get("/download/{book_id}")
-async def download_file(book_id: int):
-    from fastapi.responses import FileResponse
+async def download_file(book_id: int, request: Request):
+    user_id = request.cookies.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Требуется авторизация")
     response = await make_request("GET", f"{DB_DOCKER_URL}/books/{book_id}/")
-    book = response.json()
+    book = decode_response(response)
+    if book["user_id"] != int(user_id):
+        raise HTTPException(
+            status_code=403, detail="Скачивание книги не разрешено")
     file_path = book["file_path"]
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="Файл не найден")
+    if DOWNLOAD_ACCEL:
+        accel_response = accel_redirect_response(file_path)
+        if accel_response is not None:
+            return accel_response
     return FileResponse(path=file_path, filename=os.path.basename(file_path), media_type="application/octet-stream")
 
 
@@ -305,7 +432,7 @@ async def edit_book_get(request: Request, book_id: int):
     if not user_id:
         raise HTTPException(status_code=401, detail="Требуется авторизация")
     response = await make_request("GET", f"{DB_DOCKER_URL}/books/{book_id}/")
-    book = response.json()
+    book = decode_response(response)
     if book["user_id"] != int(user_id):
         raise HTTPException(
             status_code=403, detail="Редактирование книги не разрешено")
@@ -331,7 +458,7 @@ async def edit_book_post(
 
     # Получение информации о книге
     book_response = await make_request("GET", f"{DB_DOCKER_URL}/books/{book_id}/")
-    book = book_response.json()
+    book = decode_response(book_response)
     if book["user_id"] != int(user_id):
         raise HTTPException(
             status_code=403, detail="Editing the book is not allowed")
@@ -339,14 +466,17 @@ async def edit_book_post(
     # Установка текущих путей
     book_path = book["file_path"]
     cover_path = book["cover_path"]
+    file_crc = book.get("file_crc")
 
     # Проверка загрузки нового файла книги
     if book_file and book_file.filename:
         filename = await generate_filename(user_id, book_file.filename)
         book_path = os.path.join(UPLOAD_DIR, filename)
         from aiofiles import open as aio_open
+        content = await book_file.read()
         async with aio_open(book_path, "wb") as f:
-            await f.write(await book_file.read())
+            await f.write(content)
+        file_crc = await asyncio.to_thread(zlib.crc32, content)
 
         # Генерация обложки только при обновлении файла
         cover_path = await generate_cover_image(book_path, user_id)
@@ -357,7 +487,8 @@ async def edit_book_post(
         "author": author,
         "description": description,
         "file_path": book_path,
-        "cover_path": cover_path
+        "cover_path": cover_path,
+        "file_crc": file_crc
     })
     return RedirectResponse(url="/", status_code=303)
 
@@ -368,7 +499,7 @@ async def delete_book_route(book_id: int, request: Request):
     if not user_id:
         raise HTTPException(status_code=401, detail="authorization required")
     response = await make_request("GET", f"{DB_DOCKER_URL}/books/{book_id}/")
-    book = response.json()
+    book = decode_response(response)
     if book["user_id"] != int(user_id):
         raise HTTPException(
             status_code=403, detail="You don't have permission to delete this book")
@@ -385,6 +516,121 @@ async def delete_book_route(book_id: int, request: Request):
         print(f"Error deleting files: {e}")
     return RedirectResponse(url="/", status_code=303)
 
+
+def build_export_entries(books: list) -> list:
+    """Файлы архива экспорта: книги, обложки и манифест manifest.json"""
+    entries = []
+    manifest = []
+    for book in books:
+        safe_title = re.sub(r'[\\/:*?"<>|\x00-\x1f]+', "_", book["title"]).strip()[:100]
+        item = {key: book.get(key) for key in ("id", "title", "author", "description")}
+
+        file_path = book["file_path"]
+        if os.path.isfile(file_path):
+            stat = os.stat(file_path)
+            name = f"books/{book['id']} - {safe_title}{Path(file_path).suffix}"
+            entries.append(ZipEntry(name, stat.st_size, stat.st_mtime,
+                                    path=file_path, crc=book.get("file_crc")))
+            item["file"] = name
+
+        cover_path = book.get("cover_path") or ""
+        cover_file = BASE_DIR / cover_path.lstrip("/")
+        if cover_path.startswith("/static/covers/") and cover_file.is_file():
+            stat = cover_file.stat()
+            name = f"covers/{book['id']}{cover_file.suffix}"
+            entries.append(ZipEntry(name, stat.st_size, stat.st_mtime, path=str(cover_file)))
+            item["cover"] = name
+
+        manifest.append(item)
+
+    data = json.dumps({"books": manifest}, ensure_ascii=False, indent=2).encode("utf-8")
+    mtime = max((entry.mtime for entry in entries), default=0)
+    entries.append(ZipEntry("manifest.json", len(data), mtime, data=data))
+    return entries
+
+
+@app.get("/export")
+async def export_library(request: Request):
+    """Экспорт всей библиотеки пользователя в ZIP (потоково, с поддержкой Range)"""
+    user_id = request.cookies.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Требуется авторизация")
+
+    response = await make_request("GET", f"{DB_DOCKER_URL}/books/?user_id={user_id}")
+    books = decode_response(response)
+    archive = ZipStream(await asyncio.to_thread(build_export_entries, books))
+
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": archive.etag,
+        "Content-Disposition": f"attachment; filename=meowlib-{user_id}.zip",
+    }
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range == archive.etag):
+        try:
+            byte_range = parse_byte_range(range_header, archive.size)
+        except ValueError:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{archive.size}"})
+
+    if byte_range is None:
+        headers["Content-Length"] = str(archive.size)
+        return StreamingResponse(archive.iter_bytes(), media_type="application/zip", headers=headers)
+
+    start, end = byte_range
+    headers["Content-Length"] = str(end - start + 1)
+    headers["Content-Range"] = f"bytes {start}-{end}/{archive.size}"
+    return StreamingResponse(archive.iter_bytes(start, end), status_code=206,
+                             media_type="application/zip", headers=headers)
+
+
+@app.get("/changes")
+async def read_changes(request: Request, since: int = 0, wait: float = 0):
+    """Лента изменений книг пользователя после курсора since (long-poll через wait)"""
+    user_id = request.cookies.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Требуется авторизация")
+    response = await make_request(
+        "GET",
+        f"{DB_DOCKER_URL}/changes/",
+        params={"since": since, "user_id": user_id, "wait": wait},
+        timeout=wait + 5
+    )
+    return decode_response(response)
+
+
+@app.put("/progress/{book_id}")
+async def report_progress(
+        request: Request,
+        book_id: int,
+        locator: str = Body(...),
+        percent: float = Body(...)):
+    """Отчёт о позиции чтения из браузера или OPDS-клиента"""
+    user_id = request.cookies.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Требуется авторизация")
+    response = await make_request("PUT", f"{DB_DOCKER_URL}/progress/", json={
+        "user_id": user_id,
+        "book_id": book_id,
+        "locator": locator,
+        "percent": percent
+    })
+    return JSONResponse(status_code=202, content=decode_response(response))
+
+
+@app.get("/progress/{book_id}")
+async def read_progress(request: Request, book_id: int):
+    """Последняя позиция чтения книги"""
+    user_id = request.cookies.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Требуется авторизация")
+    response = await make_request("GET", f"{DB_DOCKER_URL}/progress/?user_id={user_id}&book_id={book_id}")
+    progress = decode_response(response)
+    if not progress:
+        raise HTTPException(status_code=404, detail="Прогресс не найден")
+    return progress[0]
+
 redis_client = redis.StrictRedis(
     host="redis", port=6379, decode_responses=True)
 
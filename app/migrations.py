@@ -0,0 +1,106 @@
+# ===== Библиотеки =====
+
+import argparse
+import logging
+import sys
+from typing import Dict, List
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Connection
+
+# ===== Миграции =====
+
+# Версия схемы хранится в PRAGMA user_version самой SQLite.
+# Каждая миграция: (версия, описание, список SQL-выражений или функций от соединения).
+# Выражения должны корректно работать и на новой БД, где таблицы и индексы
+# уже созданы через SQLModel.metadata.create_all.
+def add_column(table: str, column: str, ddl: str):
+    """Миграция-функция: добавляет столбец, если его ещё нет (на новой БД он уже создан)"""
+    def migrate(conn: Connection):
+        columns = [row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table})")]
+        if column not in columns:
+            conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+    return migrate
+
+
+MIGRATIONS = [
+    (1, "Составной индекс книг (user_id, title)", [
+        "CREATE INDEX IF NOT EXISTS ix_book_user_id_title ON book (user_id, title)",
+    ]),
+    (2, "Начальное заполнение ленты изменений существующими книгами", [
+        "INSERT INTO bookchange (book_id, user_id, op, created_at) "
+        "SELECT id, user_id, 'create', CURRENT_TIMESTAMP FROM book ORDER BY id",
+    ]),
+    (3, "CRC-32 файла книги для экспорта без повторного чтения", [
+        add_column("book", "file_crc", "INTEGER"),
+    ]),
+]
+
+def get_schema_version(conn: Connection) -> int:
+    """Текущая версия схемы БД"""
+    return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def run_migrations(conn: Connection) -> int:
+    """Применяет недостающие миграции, возвращает итоговую версию схемы"""
+    version = get_schema_version(conn)
+    for target, description, statements in MIGRATIONS:
+        if target <= version:
+            continue
+        for statement in statements:
+            if callable(statement):
+                statement(conn)
+            else:
+                conn.exec_driver_sql(statement)
+        conn.exec_driver_sql(f"PRAGMA user_version = {target}")
+        version = target
+        logging.info(f"✅ Миграция {target}: {description}")
+    return version
+
+
+def explain_query_plan(conn: Connection, query: str) -> List[str]:
+    """Возвращает строки EXPLAIN QUERY PLAN для запроса"""
+    rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {query}").fetchall()
+    return [row[-1] for row in rows]
+
+
+def find_full_scans(conn: Connection, queries: Dict[str, str]) -> dict:
+    """
+    Ищет горячие запросы, план которых содержит сканирование или сортировку во временном B-дереве.
+    queries — {название: SQL}, обычно database.hot_queries().
+    """
+    regressions = {}
+    for name, query in queries.items():
+        bad = [detail for detail in explain_query_plan(conn, query)
+               if detail.startswith("SCAN") or "TEMP B-TREE" in detail]
+        if bad:
+            regressions[name] = bad
+    return regressions
+
+
+# ===== CLI =====
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Миграции БД Meowlib")
+    parser.add_argument("--check", action="store_true",
+                        help="проверить планы горячих запросов (EXPLAIN QUERY PLAN)")
+    args = parser.parse_args()
+
+    from database import DB_PATH, hot_queries
+    engine = create_engine(f"sqlite:///{DB_PATH.resolve()}")
+    with engine.begin() as conn:
+        version = run_migrations(conn)
+        logging.info(f"Версия схемы: {version}")
+        if args.check:
+            regressions = find_full_scans(conn, hot_queries())
+            for name, details in regressions.items():
+                logging.error(f"❌ {name}: {'; '.join(details)}")
+            if regressions:
+                return 1
+            logging.info("✅ Планы горячих запросов используют индексы")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
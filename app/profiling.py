@@ -0,0 +1,273 @@
+# ===== Библиотеки =====
+
+import asyncio
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from pathlib import Path
+from types import FrameType
+from typing import List, Optional
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# ===== Конфигурация =====
+
+# Пустой токен отключает ручной запуск профилирования и скачивание профилей
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+# Доля запросов, профилируемых автоматически (0 — выключено)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+# Интервал сэмплирования стека, сек (чаще не даст переключение GIL, ~5 мс)
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.005))
+# Сколько последних профилей хранить
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", 100))
+PROFILE_DIR = Path(os.getcwd()).resolve() / os.getenv("PROFILE_DIR", "data/profiles")
+
+# Тайминги SQL текущего профилируемого запроса
+_sql_timings: ContextVar[Optional[List[dict]]] = ContextVar("sql_timings", default=None)
+# Идентификаторы профилей внутренних запросов (сервис БД) текущего профилируемого запроса
+_downstream: ContextVar[Optional[List[str]]] = ContextVar("downstream_profiles", default=None)
+
+
+# ===== Сэмплер стека =====
+
+
+class StackSampler:
+    """
+    Статистический профайлер: периодически снимает стек потока цикла событий.
+    С root в samples попадают только стеки, проходящие через этот кадр,
+    остальные (другие запросы на том же цикле) лишь считаются в total.
+    """
+
+    def __init__(self, thread_id: int, interval: float, root: Optional[FrameType] = None):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.root = root
+        self.samples = Counter()
+        self.total = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            inside = self.root is None
+            while frame is not None:
+                inside = inside or frame is self.root
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if not stack:
+                continue
+            self.total += 1
+            if inside:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def folded(self) -> str:
+        """Стеки в формате collapsed (flamegraph.pl, speedscope, inferno)"""
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.items())
+
+
+# ===== Профайлер запросов =====
+
+
+class RequestProfiler:
+    """
+    Профилирование отдельных запросов: по токену в заголовке X-Profile
+    или параметре ?profile=, либо случайная выборка PROFILE_SAMPLE_RATE.
+    """
+
+    def __init__(self, service: str):
+        self.service = service
+        self.router = APIRouter(prefix="/debug/profiles")
+        self.router.add_api_route("/", self.list_profiles, methods=["GET"])
+        self.router.add_api_route("/{name}", self.download_profile, methods=["GET"])
+
+    @property
+    def enabled(self) -> bool:
+        return bool(PROFILE_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+    def _has_token(self, request: Request, header: str, param: str) -> bool:
+        token = request.headers.get(header) or request.query_params.get(param)
+        # compare_digest принимает только ASCII-строки, поэтому сравниваем байты
+        return bool(PROFILE_TOKEN) and bool(token) and hmac.compare_digest(
+            token.encode("utf-8"), PROFILE_TOKEN.encode("utf-8"))
+
+    def should_profile(self, request: Request) -> bool:
+        if self._has_token(request, "x-profile", "profile"):
+            return True
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    def install(self, app, engine: Optional[Engine] = None):
+        """Подключает middleware и маршруты; при выключенном профилировании ничего не делает"""
+        if not self.enabled:
+            return
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        app.add_middleware(ProfilingMiddleware, profiler=self)
+        app.include_router(self.router)
+        if engine is not None:
+            instrument_engine(engine)
+        logging.info(f"Профилирование запросов включено ({self.service})")
+
+    async def profile(self, request: Request, app, receive, send):
+        """
+        Выполняет запрос под профайлером. Запрос идёт в задаче этого вызова,
+        поэтому в профиль попадают только стеки, проходящие через его кадр;
+        работа в дочерних задачах и потоках в стеки не попадает.
+        """
+        name = self._profile_name(request)
+        status = []
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                status.append(message["status"])
+                message = {**message, "headers": [
+                    *message.get("headers", []), (b"x-profile-id", name.encode())]}
+            await send(message)
+
+        timings = []
+        downstream = []
+        token = _sql_timings.set(timings)
+        downstream_token = _downstream.set(downstream)
+        sampler = StackSampler(threading.get_ident(), PROFILE_INTERVAL, sys._getframe())
+        started = time.perf_counter()
+        sampler.start()
+        try:
+            await app(request.scope, receive, send_with_profile_id)
+        finally:
+            sampler.stop()
+            sampler.root = None
+            _sql_timings.reset(token)
+            _downstream.reset(downstream_token)
+        duration = time.perf_counter() - started
+
+        summary = {
+            "service": self.service,
+            "method": request.method,
+            "path": request.url.path,
+            "status": status[0] if status else None,
+            "duration_ms": round(duration * 1000, 3),
+            "samples": sum(sampler.samples.values()),
+            # Все снимки цикла событий за время запроса, включая другие запросы
+            "loop_samples": sampler.total,
+            "sql": timings,
+            "downstream": downstream,
+        }
+        try:
+            await asyncio.to_thread(self._save, name, sampler.folded(), summary)
+        except OSError as e:
+            logging.error(f"❌ Ошибка сохранения профиля {name}: {e}")
+
+    def _profile_name(self, request: Request) -> str:
+        slug = re.sub(r"[^A-Za-z0-9]+", "_", request.url.path).strip("_") or "root"
+        return f"{self.service}-{time.time_ns()}-{request.method.lower()}-{slug}"
+
+    def _save(self, name: str, folded: str, summary: dict):
+        (PROFILE_DIR / f"{name}.folded").write_text(folded, encoding="utf-8")
+        (PROFILE_DIR / f"{name}.json").write_text(
+            json.dumps(summary, ensure_ascii=False, indent=2), encoding="utf-8")
+
+        # Удаляем самые старые профили сверх лимита
+        summaries = sorted(PROFILE_DIR.glob("*.json"), key=lambda path: path.stat().st_mtime)
+        for path in summaries[:-PROFILE_KEEP]:
+            path.unlink(missing_ok=True)
+            path.with_suffix(".folded").unlink(missing_ok=True)
+
+    def _check_access(self, request: Request):
+        if not self._has_token(request, "x-profile-token", "token"):
+            raise HTTPException(status_code=403, detail="Доступ запрещён")
+
+    async def list_profiles(self, request: Request):
+        """Список сохранённых профилей"""
+        self._check_access(request)
+        paths = sorted(PROFILE_DIR.glob("*.json"), key=lambda path: path.stat().st_mtime, reverse=True)
+        return [path.stem for path in paths]
+
+    async def download_profile(self, request: Request, name: str):
+        """Скачивание профиля: name.folded (flamegraph) или name.json (SQL и сводка)"""
+        self._check_access(request)
+        path = PROFILE_DIR / Path(name).name
+        if path.suffix not in (".folded", ".json") or not path.exists():
+            raise HTTPException(status_code=404, detail="Профиль не найден")
+        return FileResponse(path=path, filename=path.name)
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware профайлера. Не BaseHTTPMiddleware: тот запускает приложение
+    в отдельной задаче, и стеки запроса нельзя было бы отличить от чужих.
+    """
+
+    def __init__(self, app, profiler: RequestProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request = Request(scope)
+        if not self.profiler.should_profile(request):
+            await self.app(scope, receive, send)
+            return
+        await self.profiler.profile(request, self.app, receive, send)
+
+
+# ===== Внутренние запросы =====
+
+
+def downstream_headers() -> dict:
+    """Заголовки внутреннего запроса: во время профилируемого запроса профилируется и он"""
+    if PROFILE_TOKEN and _downstream.get() is not None:
+        return {"X-Profile": PROFILE_TOKEN}
+    return {}
+
+
+def record_downstream(response):
+    """Запоминает в сводке идентификатор профиля, сохранённого сервисом БД"""
+    downstream = _downstream.get()
+    profile_id = response.headers.get("X-Profile-Id")
+    if downstream is not None and profile_id:
+        downstream.append(profile_id)
+
+
+# ===== Тайминги SQL =====
+
+
+def instrument_engine(engine: Engine):
+    """Подписывается на события движка и пишет длительность запросов профилируемого запроса"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if _sql_timings.get() is not None:
+            conn.info.setdefault("profile_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        timings = _sql_timings.get()
+        starts = conn.info.get("profile_query_start")
+        if timings is None or not starts:
+            return
+        timings.append({
+            "statement": statement,
+            "duration_ms": round((time.perf_counter() - starts.pop()) * 1000, 3),
+        })
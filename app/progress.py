@@ -0,0 +1,120 @@
+# ===== Библиотеки =====
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+# ===== Буфер прогресса чтения =====
+
+Key = Tuple[int, int]
+
+
+class ProgressBuffer:
+    """
+    Буфер прогресса чтения в памяти.
+    Хранит только последнюю позицию для пары (user_id, book_id)
+    и периодически сбрасывает накопленное в БД одним пакетом.
+    """
+
+    def __init__(self, flush: Callable[[List[dict]], Awaitable[None]],
+                 interval: float = 5.0, max_pending: int = 1000):
+        self._flush = flush
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending: Dict[Key, dict] = {}
+        self._flushing: Dict[Key, dict] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+        # Метрики
+        self.received = 0
+        self.written = 0
+        self.flushes = 0
+        self.errors = 0
+
+    def put(self, record: dict) -> dict:
+        """Добавляет отчёт о позиции; более старые отчёты не затирают новые"""
+        key = (record["user_id"], record["book_id"])
+        current = self._pending.get(key)
+        if current is None or record["updated_at"] >= current["updated_at"]:
+            self._pending[key] = record
+        self.received += 1
+        if len(self._pending) >= self.max_pending:
+            self._wakeup.set()
+        return self._pending[key]
+
+    def get(self, user_id: int, book_id: int) -> Optional[dict]:
+        """Несброшенная позиция (включая пакет, который сейчас пишется в БД)"""
+        key = (user_id, book_id)
+        return self._pending.get(key) or self._flushing.get(key)
+
+    def discard_book(self, book_id: int):
+        """Забывает несброшенные позиции удалённой книги"""
+        for key in [key for key in self._pending if key[1] == book_id]:
+            del self._pending[key]
+
+    def pending_for_user(self, user_id: int) -> List[dict]:
+        """Все несброшенные позиции пользователя"""
+        records = {**self._flushing, **self._pending}
+        return [record for key, record in records.items() if key[0] == user_id]
+
+    async def flush(self):
+        """Сбрасывает накопленные позиции в БД"""
+        if not self._pending:
+            return
+        self._flushing, self._pending = self._pending, {}
+        try:
+            await self._flush(list(self._flushing.values()))
+        except BaseException:
+            # В том числе отмена задачи: пакет не должен потеряться
+            self.errors += 1
+            # Возвращаем пакет в буфер, не затирая более свежие отчёты
+            for key, record in self._flushing.items():
+                self._pending.setdefault(key, record)
+            raise
+        finally:
+            written = len(self._flushing)
+            self._flushing = {}
+        self.written += written
+        self.flushes += 1
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"❌ Ошибка записи прогресса чтения: {e}")
+
+    def start(self):
+        """Запуск фоновой задачи периодического сброса"""
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановка: дожидается текущего сброса (без отмены) и записывает остаток"""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.error(f"❌ Прогресс чтения не записан при остановке: {e}")
+
+    def metrics(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "received": self.received,
+            "written": self.written,
+            "flushes": self.flushes,
+            "errors": self.errors,
+            # Сколько отчётов в среднем сворачивается в одну запись БД
+            "coalescing_ratio": self.received / self.written if self.written else 0.0,
+        }
@@ -0,0 +1,196 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.testclient import TestClient
+
+import main
+import admission
+from admission import AdmissionMiddleware, AdmissionRule, ConcurrencyLimiter, RateLimiter, ip_key
+
+
+async def expensive(limiter: ConcurrencyLimiter, duration: float) -> float:
+    """Имитация дорогого запроса; возвращает время до ответа (успех или отказ)."""
+    started = time.monotonic()
+    try:
+        async with limiter.slot():
+            await asyncio.sleep(duration)
+    except HTTPException as e:
+        assert e.status_code == 503
+        assert "Retry-After" in e.headers
+    return time.monotonic() - started
+
+
+def test_limiter_sheds_flood_fast():
+    """При переполнении очереди лишние запросы сразу получают 503."""
+    limiter = ConcurrencyLimiter("test", limit=2, queue_size=2, timeout=5)
+
+    async def scenario():
+        flood = [asyncio.create_task(expensive(limiter, 0.2)) for _ in range(20)]
+        await asyncio.sleep(0)
+        assert limiter.active <= 2
+        return await asyncio.gather(*flood)
+
+    durations = asyncio.run(scenario())
+    assert limiter.admitted == 4
+    assert limiter.rejected == 16
+    rejected = sorted(durations)[:16]
+    assert max(rejected) < 0.05, "Отказ должен приходить без ожидания"
+
+
+def test_limiter_queue_timeout():
+    """Запрос, простоявший в очереди дольше таймаута, получает 503."""
+    limiter = ConcurrencyLimiter("test", limit=1, queue_size=5, timeout=0.05)
+
+    async def scenario():
+        return await asyncio.gather(expensive(limiter, 0.2), expensive(limiter, 0.2))
+
+    asyncio.run(scenario())
+    assert limiter.admitted == 1
+    assert limiter.rejected == 1
+    assert limiter.metrics()["wait_max"] < 0.05
+
+
+def test_rate_limiter_token_bucket():
+    """После исчерпания всплеска клиент получает 429, другие клиенты — нет."""
+    limiter = RateLimiter("test", rate=1, burst=3)
+    for _ in range(3):
+        limiter.check("ip:1")
+
+    with pytest.raises(HTTPException) as exc_info:
+        limiter.check("ip:1")
+    assert exc_info.value.status_code == 429
+    assert int(exc_info.value.headers["Retry-After"]) >= 1
+
+    limiter.check("ip:2")
+    assert limiter.rejected == 1
+
+
+def make_app(limiter: ConcurrencyLimiter, rate_limiter: RateLimiter = None) -> FastAPI:
+    """Приложение с дорогим (медленным) и дешёвым маршрутами."""
+    app = FastAPI()
+    app.add_middleware(AdmissionMiddleware, rules={
+        ("POST", "/expensive"): AdmissionRule(limiter, rate_limiter, key=ip_key)})
+
+    @app.post("/expensive")
+    async def expensive_route(request: Request):
+        await request.body()
+        await asyncio.sleep(0.3)
+        return {"ok": True}
+
+    @app.get("/cheap")
+    async def cheap_route():
+        return {"ok": True}
+
+    return app
+
+
+def test_cheap_route_latency_under_expensive_flood():
+    """Пока дорогой маршрут перегружен, дешёвый отвечает быстро, лишние дорогие — сразу 503."""
+    limiter = ConcurrencyLimiter("expensive", limit=2, queue_size=4, timeout=5)
+    app = make_app(limiter)
+
+    async def timed(client, method, url):
+        started = time.monotonic()
+        response = await client.request(method, url, content=b"x" * 1024)
+        return response, time.monotonic() - started
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://main") as client:
+            flood = [asyncio.create_task(timed(client, "POST", "/expensive")) for _ in range(30)]
+            await asyncio.sleep(0.05)
+            assert limiter.active == 2 and limiter.waiting == 4
+            cheap = [await timed(client, "GET", "/cheap") for _ in range(10)]
+            return await asyncio.gather(*flood), cheap
+
+    flood, cheap = asyncio.run(scenario())
+    assert all(response.status_code == 200 for response, _ in cheap)
+    assert max(duration for _, duration in cheap) < 0.1
+
+    rejected = [(response, duration) for response, duration in flood if response.status_code == 503]
+    assert len(rejected) == 24
+    assert all(response.headers["Retry-After"] for response, _ in rejected)
+    assert max(duration for _, duration in rejected) < 0.1
+    assert limiter.metrics()["admitted"] == 6
+
+
+def test_rejected_request_body_is_not_read():
+    """Отказ отправляется до чтения тела: загрузка не принимается."""
+    rate_limiter = RateLimiter("expensive", rate=0.001, burst=1)
+    rate_limiter.check("ip:testclient")
+    middleware = AdmissionMiddleware(make_app(ConcurrencyLimiter("expensive", 1, 1, 1)), rules={
+        ("POST", "/expensive"): AdmissionRule(ConcurrencyLimiter("expensive", 1, 1, 1), rate_limiter)})
+    body_reads = []
+    sent = []
+
+    async def receive():
+        body_reads.append(True)
+        return {"type": "http.request", "body": b"x" * 1024, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": "/expensive", "headers": [],
+             "client": ("testclient", 123), "query_string": b""}
+    asyncio.run(middleware(scope, receive, send))
+    assert sent[0]["status"] == 429
+    assert body_reads == []
+
+
+def test_login_rate_limit_ignores_user_id_cookie(monkeypatch):
+    """Вход ограничивается по IP: смена cookie user_id не обходит лимит."""
+    async def authenticate(*args, **kwargs):
+        return httpx.Response(200, json={"user_id": 1, "username": "cat"})
+
+    monkeypatch.setattr(main, "make_request", authenticate)
+    monkeypatch.setattr(main.auth_rate_limiter, "_buckets", {})
+
+    statuses = []
+    with TestClient(main.app) as client:
+        for attempt in range(main.AUTH_BURST + 2):
+            client.cookies.set("user_id", str(attempt))
+            response = client.post("/login", data={"login": "cat", "password": "meowmeow"},
+                                   follow_redirects=False)
+            statuses.append(response.status_code)
+
+    assert statuses[:main.AUTH_BURST] == [303] * main.AUTH_BURST
+    assert statuses[main.AUTH_BURST:] == [429, 429]
+
+
+def test_upload_key_requires_signed_session():
+    """Загрузка ограничивается по пользователю только при подтверждённой сессии."""
+    from admission import user_key
+    from starlette.requests import Request as StarletteRequest
+
+    def request(cookie_user_id, session):
+        return StarletteRequest({
+            "type": "http", "headers": [(b"cookie", f"user_id={cookie_user_id}".encode())],
+            "client": ("10.0.0.1", 1), "session": session})
+
+    assert user_key(request("7", {"user_id": 7})) == "user:7"
+    assert user_key(request("8", {"user_id": 7})) == "ip:10.0.0.1"
+    assert user_key(request("7", {})) == "ip:10.0.0.1"
+
+
+def test_real_ip_trusted_only_from_proxy(monkeypatch):
+    """X-Real-IP от недоверенного клиента игнорируется: подмена не даёт новый лимит."""
+    monkeypatch.setattr(admission, "TRUSTED_PROXIES", [admission.ipaddress.ip_network("10.0.0.0/24")])
+    rate_limiter = RateLimiter("auth", rate=0.001, burst=2)
+
+    def check(peer, real_ip):
+        request = Request({"type": "http", "headers": [(b"x-real-ip", real_ip.encode())],
+                           "client": (peer, 1)})
+        rate_limiter.check(ip_key(request))
+
+    check("203.0.113.5", "198.51.100.1")
+    check("203.0.113.5", "198.51.100.2")
+    with pytest.raises(HTTPException) as exc_info:
+        check("203.0.113.5", "198.51.100.3")
+    assert exc_info.value.status_code == 429
+
+    # За доверенным прокси клиенты различаются по X-Real-IP
+    check("10.0.0.2", "198.51.100.1")
+    check("10.0.0.2", "198.51.100.2")
@@ -0,0 +1,153 @@
+import asyncio
+import time
+
+import httpx
+from faker import Faker
+
+import database
+
+faker = Faker()
+
+
+def run(scenario):
+    """Запускает сценарий против ASGI-приложения сервиса БД с созданными таблицами."""
+    async def wrapper():
+        await database.create_db_and_tables()
+        transport = httpx.ASGITransport(app=database.app)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url="http://database") as client:
+                return await scenario(client)
+        finally:
+            await database.engine.dispose()
+    return asyncio.run(wrapper())
+
+
+async def create_user(client: httpx.AsyncClient) -> int:
+    response = await client.post("/users/", json={
+        "username": faker.unique.user_name(),
+        "email": faker.unique.email(),
+        "password": faker.password(),
+    })
+    assert response.status_code == 200, response.text
+    return response.json()["id"]
+
+
+async def create_book(client: httpx.AsyncClient, user_id: int, title: str = "Test Book") -> int:
+    response = await client.post("/books/", json={
+        "title": title,
+        "author": "Test Author",
+        "description": "Test Description",
+        "file_path": "/tmp/test_book.epub",
+        "cover_path": None,
+        "user_id": user_id,
+    })
+    assert response.status_code == 200, response.text
+    return response.json()["id"]
+
+
+async def read_changes(client: httpx.AsyncClient, user_id: int, since: int = 0, **params) -> dict:
+    response = await client.get("/changes/", params={"user_id": user_id, "since": since, **params})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_create_update_delete_feed():
+    """Создание, изменение и удаление попадают в ленту, удаление — надгробием."""
+    async def scenario(client):
+        user_id = await create_user(client)
+        book_id = await create_book(client, user_id)
+        first = await read_changes(client, user_id)
+        assert [(c["op"], c["book_id"]) for c in first["changes"]] == [("create", book_id)]
+        assert first["changes"][0]["book"]["title"] == "Test Book"
+
+        response = await client.patch(f"/books/{book_id}/", json={"title": "Renamed"})
+        assert response.status_code == 200, response.text
+        second = await read_changes(client, user_id, first["cursor"])
+        assert [c["op"] for c in second["changes"]] == ["update"]
+        assert second["changes"][0]["book"]["title"] == "Renamed"
+        assert second["cursor"] > first["cursor"]
+
+        response = await client.delete(f"/books/{book_id}/")
+        assert response.status_code == 200, response.text
+        third = await read_changes(client, user_id, second["cursor"])
+        assert [(c["op"], c["book"]) for c in third["changes"]] == [("delete", None)]
+
+        # С нулевого курсора для книги остаётся только последнее изменение
+        full = await read_changes(client, user_id)
+        assert [c["op"] for c in full["changes"]] == ["delete"]
+        assert full["cursor"] == third["cursor"]
+
+    run(scenario)
+
+
+def test_owner_change_is_delete_and_create():
+    """Смена владельца — надгробие для прежнего и создание для нового."""
+    async def scenario(client):
+        old_owner = await create_user(client)
+        new_owner = await create_user(client)
+        book_id = await create_book(client, old_owner)
+        old_cursor = (await read_changes(client, old_owner))["cursor"]
+        new_cursor = (await read_changes(client, new_owner))["cursor"]
+
+        response = await client.patch("/books/", json=[{"id": book_id, "user_id": new_owner}])
+        assert response.status_code == 200, response.text
+
+        old_feed = await read_changes(client, old_owner, old_cursor)
+        assert [(c["op"], c["book_id"], c["book"]) for c in old_feed["changes"]] == [
+            ("delete", book_id, None)]
+        new_feed = await read_changes(client, new_owner, new_cursor)
+        assert [(c["op"], c["book_id"]) for c in new_feed["changes"]] == [("create", book_id)]
+        assert new_feed["changes"][0]["book"]["user_id"] == new_owner
+
+    run(scenario)
+
+
+def test_old_page_does_not_leak_new_owner_book():
+    """Старое изменение книги, сменившей владельца, приходит прежнему владельцу надгробием."""
+    async def scenario(client):
+        old_owner = await create_user(client)
+        new_owner = await create_user(client)
+        cursor = (await read_changes(client, old_owner))["cursor"]
+        book_id = await create_book(client, old_owner, title="Secret Diary")
+
+        response = await client.patch("/books/", json=[
+            {"id": book_id, "user_id": new_owner, "title": "New Owner Title"}])
+        assert response.status_code == 200, response.text
+
+        page = await read_changes(client, old_owner, cursor, limit=1)
+        assert [(c["op"], c["book_id"], c["book"]) for c in page["changes"]] == [
+            ("delete", book_id, None)]
+        rest = await read_changes(client, old_owner, page["cursor"])
+        assert [(c["op"], c["book"]) for c in rest["changes"]] == [("delete", None)]
+
+    run(scenario)
+
+
+def test_long_poll_wakes_up_on_change():
+    """Long-poll запрос возвращается сразу после изменения, не дожидаясь таймаута."""
+    async def scenario(client):
+        user_id = await create_user(client)
+        cursor = (await read_changes(client, user_id))["cursor"]
+
+        started = time.monotonic()
+        waiter = asyncio.create_task(read_changes(client, user_id, cursor, wait=10))
+        await asyncio.sleep(0.2)
+        assert not waiter.done()
+
+        book_id = await create_book(client, user_id)
+        feed = await asyncio.wait_for(waiter, 5)
+        assert time.monotonic() - started < 5
+        assert [(c["op"], c["book_id"]) for c in feed["changes"]] == [("create", book_id)]
+
+    run(scenario)
+
+
+def test_long_poll_times_out_empty():
+    """Без изменений long-poll возвращает пустую страницу с прежним курсором."""
+    async def scenario(client):
+        user_id = await create_user(client)
+        cursor = (await read_changes(client, user_id))["cursor"]
+        feed = await read_changes(client, user_id, cursor, wait=0.2)
+        assert feed == {"cursor": cursor, "changes": []}
+
+    run(scenario)
@@ -0,0 +1,53 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+
+@pytest.fixture
+def book(monkeypatch):
+    """Книга пользователя 1 с файлом в UPLOAD_DIR; сервис БД подменён"""
+    file_path = main.UPLOAD_DIR / "1_download.txt"
+    file_path.write_bytes(b"meow")
+    book = {"id": 5, "user_id": 1, "file_path": str(file_path)}
+
+    async def fake_request(method, url, **kwargs):
+        assert url.endswith("/books/5/")
+        return httpx.Response(200, json=book)
+
+    monkeypatch.setattr(main, "make_request", fake_request)
+    yield book
+    file_path.unlink()
+
+
+def download(user_id=None) -> httpx.Response:
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        cookies = {"user_id": str(user_id)} if user_id is not None else {}
+        async with httpx.AsyncClient(transport=transport, base_url="http://main", cookies=cookies) as client:
+            return await client.get("/download/5")
+
+    return asyncio.run(scenario())
+
+
+def test_download_requires_owner(book):
+    """Скачать книгу может только её владелец."""
+    assert download().status_code == 401
+    assert download(user_id=2).status_code == 403
+
+    response = download(user_id=1)
+    assert response.status_code == 200
+    assert response.content == b"meow"
+
+
+def test_download_accel_redirect(book, monkeypatch):
+    """С DOWNLOAD_ACCEL файл отдаёт nginx, но только после проверки владельца."""
+    monkeypatch.setattr(main, "DOWNLOAD_ACCEL", True)
+    response = download(user_id=2)
+    assert response.status_code == 403
+    assert "X-Accel-Redirect" not in response.headers
+
+    response = download(user_id=1)
+    assert response.headers["X-Accel-Redirect"] == main.ACCEL_REDIRECT_PREFIX + "1_download.txt"
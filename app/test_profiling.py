@@ -0,0 +1,154 @@
+import asyncio
+import functools
+import json
+import time
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import main
+import profiling
+from profiling import RequestProfiler
+
+TOKEN = "secret"
+
+
+@pytest.fixture(autouse=True)
+def profile_settings(monkeypatch, tmp_path):
+    monkeypatch.setattr(profiling, "PROFILE_TOKEN", TOKEN)
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_RATE", 0)
+    monkeypatch.setattr(profiling, "PROFILE_DIR", tmp_path)
+
+
+def make_app(service: str) -> FastAPI:
+    app = FastAPI()
+    RequestProfiler(service).install(app)
+
+    @app.get("/ping")
+    async def ping():
+        return {"ok": True}
+
+    return app
+
+
+def request(app: FastAPI, url: str, **kwargs) -> httpx.Response:
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get(url, **kwargs)
+
+    return asyncio.run(scenario())
+
+
+def test_non_ascii_token_is_rejected():
+    """Токен не из ASCII не приводит к 500: профиль не снимается, доступ запрещён."""
+    app = make_app("main")
+
+    response = request(app, "/ping?profile=%C3%A9")
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in response.headers
+
+    response = request(app, "/ping", headers={"X-Profile": "é".encode("utf-8")})
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in response.headers
+
+    assert request(app, "/debug/profiles/?token=%C3%A9").status_code == 403
+    assert request(app, f"/debug/profiles/?token={TOKEN}").status_code == 200
+
+
+def test_profile_links_database_profile(monkeypatch, tmp_path):
+    """Профилируемый запрос main профилирует и внутренний запрос к БД и ссылается на его профиль."""
+    database_app = make_app("database")
+    main_app = make_app("main")
+
+    @main_app.get("/books")
+    async def books():
+        response = await main.make_request("GET", "http://database/ping")
+        return response.json()
+
+    real_client = httpx.AsyncClient
+    monkeypatch.setattr(main.httpx, "AsyncClient", functools.partial(
+        real_client, transport=httpx.ASGITransport(app=database_app)))
+
+    async def scenario(url):
+        transport = httpx.ASGITransport(app=main_app)
+        async with real_client(transport=transport, base_url="http://test") as client:
+            return await client.get(url)
+
+    response = asyncio.run(scenario(f"/books?profile={TOKEN}"))
+    assert response.status_code == 200
+    summary = json.loads((tmp_path / f"{response.headers['X-Profile-Id']}.json").read_text())
+    [database_profile] = summary["downstream"]
+    assert database_profile.startswith("database-")
+    assert (tmp_path / f"{database_profile}.folded").exists()
+
+    # Без профилирования main внутренние запросы тоже не профилируются
+    response = asyncio.run(scenario("/books"))
+    assert "X-Profile-Id" not in response.headers
+    assert len(list(tmp_path.glob("database-*.json"))) == 1
+
+
+def busy(seconds: float):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+def test_profile_contains_only_request_stacks(tmp_path):
+    """Стеки параллельных запросов на том же цикле не попадают в профиль запроса."""
+    app = make_app("main")
+
+    @app.get("/profiled")
+    async def profiled():
+        for _ in range(8):
+            busy(0.02)
+            await asyncio.sleep(0)
+        return {}
+
+    @app.get("/other")
+    async def other():
+        for _ in range(8):
+            busy(0.02)
+            await asyncio.sleep(0)
+        return {}
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await asyncio.gather(client.get(f"/profiled?profile={TOKEN}"), client.get("/other"))
+
+    response, _ = asyncio.run(scenario())
+    name = response.headers["X-Profile-Id"]
+    folded = (tmp_path / f"{name}.folded").read_text()
+    assert "profiled (" in folded
+    assert "other (" not in folded
+
+    summary = json.loads((tmp_path / f"{name}.json").read_text())
+    assert 0 < summary["samples"] < summary["loop_samples"]
+
+
+def test_profile_records_sql_timings(tmp_path):
+    """SQL, выполненный во время профилируемого запроса, попадает в сводку с длительностью."""
+    engine = create_async_engine("sqlite+aiosqlite://")
+    app = FastAPI()
+    RequestProfiler("database").install(app, engine.sync_engine)
+
+    @app.get("/query")
+    async def query():
+        async with engine.connect() as conn:
+            return {"value": (await conn.execute(text("SELECT 42"))).scalar()}
+
+    try:
+        response = request(app, f"/query?profile={TOKEN}")
+        assert response.json() == {"value": 42}
+        summary = json.loads((tmp_path / f"{response.headers['X-Profile-Id']}.json").read_text())
+        assert [timing["statement"] for timing in summary["sql"]] == ["SELECT 42"]
+        assert summary["sql"][0]["duration_ms"] >= 0
+
+        # Без профилирования тайминги не собираются
+        assert "X-Profile-Id" not in request(app, "/query").headers
+    finally:
+        asyncio.run(engine.dispose())
@@ -0,0 +1,213 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+from progress import ProgressBuffer
+from test_changes import create_book, create_user, run
+
+NOW = datetime(2025, 1, 1)
+
+
+def report(user_id: int, book_id: int, percent: float, seconds: int = 0) -> dict:
+    return {
+        "user_id": user_id,
+        "book_id": book_id,
+        "locator": f"epubcfi(/6/{int(percent)})",
+        "percent": percent,
+        "updated_at": NOW + timedelta(seconds=seconds),
+    }
+
+
+class FakeStore:
+    """Хранилище вместо БД: запоминает пакеты сброса."""
+
+    def __init__(self, fail: bool = False):
+        self.batches = []
+        self.fail = fail
+
+    async def __call__(self, records):
+        if self.fail:
+            raise RuntimeError("database is locked")
+        self.batches.append(records)
+
+
+def test_buffer_coalesces_reports():
+    """В БД уходит только последняя позиция для пары (пользователь, книга)."""
+    store = FakeStore()
+    buffer = ProgressBuffer(store)
+    for second in range(10):
+        buffer.put(report(1, 1, second * 10, second))
+    buffer.put(report(1, 2, 50))
+
+    asyncio.run(buffer.flush())
+
+    assert len(store.batches) == 1
+    written = {record["book_id"]: record["percent"] for record in store.batches[0]}
+    assert written == {1: 90, 2: 50}
+    assert buffer.metrics()["coalescing_ratio"] == pytest.approx(11 / 2)
+
+
+def test_buffer_keeps_newest_report():
+    """Запоздавший старый отчёт не затирает более новый."""
+    buffer = ProgressBuffer(FakeStore())
+    buffer.put(report(1, 1, 80, seconds=10))
+    buffer.put(report(1, 1, 20, seconds=5))
+    assert buffer.get(1, 1)["percent"] == 80
+
+
+def test_reads_see_unflushed_values():
+    """Чтение видит позиции, ещё не записанные в БД."""
+    buffer = ProgressBuffer(FakeStore())
+    buffer.put(report(1, 1, 42))
+    buffer.put(report(2, 1, 10))
+
+    assert buffer.get(1, 1)["percent"] == 42
+    assert [record["user_id"] for record in buffer.pending_for_user(1)] == [1]
+
+
+def test_failed_flush_keeps_reports():
+    """При ошибке записи отчёты остаются в буфере до следующего сброса."""
+    store = FakeStore(fail=True)
+    buffer = ProgressBuffer(store)
+    buffer.put(report(1, 1, 42))
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(buffer.flush())
+    assert buffer.get(1, 1)["percent"] == 42
+
+    store.fail = False
+    asyncio.run(buffer.flush())
+    assert store.batches[0][0]["percent"] == 42
+    assert buffer.metrics()["errors"] == 1
+
+
+def test_stop_flushes_pending():
+    """При остановке сервиса накопленные позиции записываются в БД."""
+    store = FakeStore()
+
+    async def scenario():
+        buffer = ProgressBuffer(store, interval=60)
+        buffer.start()
+        buffer.put(report(1, 1, 42))
+        await buffer.stop()
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert store.batches == [[report(1, 1, 42)]]
+    assert buffer.metrics()["pending"] == 0
+
+
+class SlowStore(FakeStore):
+    """Хранилище с медленной записью."""
+
+    async def __call__(self, records):
+        await asyncio.sleep(0.2)
+        await super().__call__(records)
+
+
+def test_stop_waits_for_running_flush():
+    """Остановка во время сброса не теряет пакет, который пишется в БД."""
+    store = SlowStore()
+
+    async def scenario():
+        buffer = ProgressBuffer(store, interval=0.01)
+        buffer.start()
+        buffer.put(report(1, 1, 42))
+        await asyncio.sleep(0.05)
+        assert buffer.get(1, 1) is not None, "Пакет должен быть в процессе записи"
+        await buffer.stop()
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert store.batches == [[report(1, 1, 42)]]
+    assert buffer.metrics()["pending"] == 0
+
+
+def test_cancelled_flush_keeps_reports():
+    """Отмена задачи посреди сброса возвращает пакет в буфер."""
+    store = SlowStore()
+    buffer = ProgressBuffer(store)
+
+    async def scenario():
+        buffer.put(report(1, 1, 42))
+        task = asyncio.create_task(buffer.flush())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+    assert store.batches == []
+    assert buffer.get(1, 1)["percent"] == 42
+
+
+def test_progress_api_round_trip():
+    """Позиция видна сразу после отчёта и сохраняется в БД после сброса."""
+    async def scenario(client):
+        user_id = await create_user(client)
+        book_id = await create_book(client, user_id)
+        response = await client.put("/progress/", json={
+            "user_id": user_id, "book_id": book_id, "locator": "epubcfi(/6/4)", "percent": 12.5})
+        assert response.status_code == 202, response.text
+
+        params = {"user_id": user_id, "book_id": book_id}
+        pending = (await client.get("/progress/", params=params)).json()
+        assert [record["percent"] for record in pending] == [12.5]
+
+        await database.progress_buffer.flush()
+        assert database.progress_buffer.get(user_id, book_id) is None
+        stored = (await client.get("/progress/", params=params)).json()
+        assert [record["locator"] for record in stored] == ["epubcfi(/6/4)"]
+
+        # Более поздний несброшенный отчёт перекрывает запись в БД
+        await client.put("/progress/", json={
+            "user_id": user_id, "book_id": book_id, "locator": "epubcfi(/6/8)", "percent": 40})
+        merged = (await client.get("/progress/", params=params)).json()
+        assert [record["percent"] for record in merged] == [40]
+        await database.progress_buffer.flush()
+
+    run(scenario)
+
+
+def test_progress_rejected_for_unknown_or_foreign_book():
+    """Отчёт о несуществующей или чужой книге отклоняется, не попадая в буфер."""
+    async def scenario(client):
+        owner = await create_user(client)
+        stranger = await create_user(client)
+        book_id = await create_book(client, owner)
+
+        response = await client.put("/progress/", json={
+            "user_id": owner, "book_id": 999999, "locator": "epubcfi(/6/4)", "percent": 1})
+        assert response.status_code == 404
+        response = await client.put("/progress/", json={
+            "user_id": stranger, "book_id": book_id, "locator": "epubcfi(/6/4)", "percent": 1})
+        assert response.status_code == 403
+        assert database.progress_buffer.get(stranger, book_id) is None
+
+    run(scenario)
+
+
+def test_delete_book_removes_progress():
+    """Удаление книги удаляет её прогресс: и записанный в БД, и ещё не сброшенный."""
+    async def scenario(client):
+        user_id = await create_user(client)
+        stored_book = await create_book(client, user_id)
+        pending_book = await create_book(client, user_id)
+        for book_id in (stored_book, pending_book):
+            await client.put("/progress/", json={
+                "user_id": user_id, "book_id": book_id, "locator": "epubcfi(/6/4)", "percent": 5})
+            if book_id == stored_book:
+                await database.progress_buffer.flush()
+
+        for book_id in (stored_book, pending_book):
+            response = await client.delete(f"/books/{book_id}/")
+            assert response.status_code == 200, response.text
+        assert (await client.get("/progress/", params={"user_id": user_id})).json() == []
+
+        # Пакет, ушедший в запись до удаления книги, не создаёт осиротевших строк
+        await database.write_progress([{**report(user_id, stored_book, 7), "updated_at": database.utc_now()}])
+        assert (await client.get("/progress/", params={"user_id": user_id})).json() == []
+
+    run(scenario)
@@ -0,0 +1,53 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlmodel import SQLModel
+
+import database  # Регистрирует модели в SQLModel.metadata
+from migrations import MIGRATIONS, add_column, find_full_scans, get_schema_version, run_migrations
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://")
+    SQLModel.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+def test_hot_queries_use_indexes(engine):
+    """Горячие запросы не должны деградировать до полного сканирования таблицы."""
+    with engine.begin() as conn:
+        run_migrations(conn)
+        assert find_full_scans(conn, database.hot_queries()) == {}
+
+
+def test_hot_queries_match_endpoints():
+    """Проверяются те же выражения, что выполняют эндпоинты (с сортировкой и LIMIT)."""
+    queries = database.hot_queries()
+    assert queries["read_books(user_id)"].endswith("ORDER BY book.title")
+    assert "LIMIT" in queries["read_changes(user_id, since)"]
+
+
+def test_migrations_add_indexes_to_legacy_schema(engine):
+    """Миграции добавляют индексы в БД, созданную старой версией схемы."""
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP INDEX ix_book_user_id_title")
+        assert find_full_scans(conn, database.hot_queries()), "Без индекса ожидается сканирование"
+
+        version = run_migrations(conn)
+        assert version == MIGRATIONS[-1][0]
+        assert get_schema_version(conn) == version
+        assert find_full_scans(conn, database.hot_queries()) == {}
+
+
+def test_add_column_migration_on_legacy_table():
+    """Добавление столбца работает на старой таблице и не падает на новой."""
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE book (id INTEGER PRIMARY KEY, title VARCHAR)")
+        migrate = add_column("book", "file_crc", "INTEGER")
+        migrate(conn)
+        migrate(conn)
+        columns = [row[1] for row in conn.exec_driver_sql("PRAGMA table_info(book)")]
+        assert columns == ["id", "title", "file_crc"]
+    engine.dispose()
@@ -0,0 +1,124 @@
+import asyncio
+import io
+import os
+import zipfile
+import zlib
+
+import pytest
+
+from zipstream import ZipEntry, ZipStream, parse_byte_range
+
+
+@pytest.fixture
+def archive(tmp_path):
+    """Архив из двух файлов на диске и манифеста в памяти."""
+    entries = []
+    for name, content in [("Кот.epub", b"epub" * 100000), ("book.pdf", b"%PDF-1.4 meow")]:
+        path = tmp_path / name
+        path.write_bytes(content)
+        entries.append(ZipEntry(f"books/{name}", len(content), path.stat().st_mtime, path=str(path)))
+    manifest = b'{"books": []}'
+    entries.append(ZipEntry("manifest.json", len(manifest), 0, data=manifest))
+    return ZipStream(entries)
+
+
+def collect(archive: ZipStream, start: int = 0, end: int = None) -> bytes:
+    async def read():
+        return b"".join([chunk async for chunk in archive.iter_bytes(start, end)])
+    return asyncio.run(read())
+
+
+def test_archive_is_valid_zip(archive):
+    """Архив читается zipfile, размер совпадает с заранее вычисленным."""
+    data = collect(archive)
+    assert len(data) == archive.size
+
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == ["books/Кот.epub", "books/book.pdf", "manifest.json"]
+        assert all(info.compress_type == zipfile.ZIP_STORED for info in zf.infolist())
+        assert zf.read("books/book.pdf") == b"%PDF-1.4 meow"
+
+
+@pytest.mark.parametrize("start, end", [(0, 99), (1000, 250000), (400100, None), (30, 30)])
+def test_ranges_match_full_archive(archive, start, end):
+    """Любой диапазон совпадает с соответствующим куском полного архива."""
+    # Сначала диапазон: CRC пропущенных файлов ещё не посчитаны
+    part = collect(archive, start, end)
+    full = collect(archive)
+    stop = len(full) if end is None else end + 1
+    assert part == full[start:stop]
+
+
+def test_parse_byte_range():
+    assert parse_byte_range("bytes=0-99", 1000) == (0, 99)
+    assert parse_byte_range("bytes=500-", 1000) == (500, 999)
+    assert parse_byte_range("bytes=-100", 1000) == (900, 999)
+    assert parse_byte_range("bytes=900-5000", 1000) == (900, 999)
+    assert parse_byte_range("bytes=0-1,5-6", 1000) is None
+    with pytest.raises(ValueError):
+        parse_byte_range("bytes=1000-", 1000)
+
+
+def test_range_after_known_crcs_skips_reading(tmp_path):
+    """С известными CRC диапазон в конце архива не читает пропущенные файлы."""
+    entries = []
+    for index in range(3):
+        content = bytes([index]) * 300000
+        path = tmp_path / f"{index}.pdf"
+        path.write_bytes(content)
+        entries.append(ZipEntry(f"books/{index}.pdf", len(content), path.stat().st_mtime,
+                                path=str(path), crc=zlib.crc32(content)))
+    full = collect(ZipStream(entries))
+
+    # Первые файлы удалены: прочитать их невозможно
+    for entry in entries[:2]:
+        os.remove(entry.path)
+    archive = ZipStream([ZipEntry(entry.name, entry.size, entry.mtime, path=entry.path, crc=entry.crc)
+                         for entry in entries])
+    assert collect(archive, archive.size - 1000) == full[-1000:]
+
+    # Докачка с середины последнего файла
+    start = entries[2].offset + entries[2].header_size + 150000
+    assert collect(archive, start) == full[start:]
+
+
+def test_crc_cache_reused_by_next_archive(tmp_path):
+    """Посчитанная при отдаче CRC кэшируется для следующих запросов."""
+    path = tmp_path / "cover.jpg"
+    path.write_bytes(b"\xff\xd8 cover")
+    stat = path.stat()
+    first = ZipStream([ZipEntry("covers/1.jpg", stat.st_size, stat.st_mtime, path=str(path))])
+    assert first.entries[0].crc is None
+    collect(first)
+
+    second = ZipStream([ZipEntry("covers/1.jpg", stat.st_size, stat.st_mtime, path=str(path))])
+    assert second.entries[0].crc == zlib.crc32(b"\xff\xd8 cover")
+
+
+def test_etag_stable_after_streaming(tmp_path):
+    """ETag не меняется после (частичной) отдачи файла без сохранённой CRC: If-Range работает."""
+    path = tmp_path / "cover.jpg"
+    path.write_bytes(b"\xff\xd8 cover" * 100)
+    stat = path.stat()
+
+    def build():
+        return ZipStream([ZipEntry("covers/1.jpg", stat.st_size, stat.st_mtime, path=str(path))])
+
+    first = build()
+    etag = first.etag
+    collect(first, 0, 500)
+    assert first.etag == etag
+
+    second = build()
+    assert second.entries[0].crc is not None, "CRC должна быть взята из кэша"
+    assert second.etag == etag
+
+
+def test_stale_crc_aborts_export(tmp_path):
+    """Если сохранённая CRC не совпадает с файлом, экспорт прерывается, а не портит архив."""
+    path = tmp_path / "book.epub"
+    path.write_bytes(b"new content")
+    archive = ZipStream([ZipEntry("books/book.epub", 11, 0, path=str(path), crc=zlib.crc32(b"old content"))])
+    with pytest.raises(IOError):
+        collect(archive)
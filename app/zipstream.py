@@ -0,0 +1,258 @@
+# ===== Библиотеки =====
+
+import hashlib
+import struct
+import time
+import zlib
+from collections import OrderedDict
+from typing import AsyncIterator, List, Optional, Tuple
+
+import aiofiles
+
+# ===== Константы формата ZIP =====
+
+CHUNK_SIZE = 1024 * 1024
+
+ZIP_VERSION = 45  # ZIP64
+FLAGS = 0x0008 | 0x0800  # Data descriptor после данных, имена в UTF-8
+MADE_BY_UNIX = (3 << 8) | ZIP_VERSION
+FILE_ATTRIBUTES = 0o100644 << 16
+UINT32_MAX = 0xFFFFFFFF
+UINT16_MAX = 0xFFFF
+
+LOCAL_HEADER_SIZE = 30
+LOCAL_ZIP64_EXTRA_SIZE = 20
+DESCRIPTOR_SIZE = 24
+CENTRAL_HEADER_SIZE = 46
+CENTRAL_ZIP64_EXTRA_SIZE = 28
+END_RECORDS_SIZE = 56 + 20 + 22
+
+# Кэш CRC-32 файлов без сохранённой контрольной суммы (обложки, старые книги):
+# ключ (путь, размер, mtime), чтобы изменённый файл посчитался заново
+CRC_CACHE_SIZE = 10000
+_crc_cache: "OrderedDict[Tuple[str, int, float], int]" = OrderedDict()
+
+
+def cached_crc(path: str, size: int, mtime: float) -> Optional[int]:
+    key = (path, size, mtime)
+    crc = _crc_cache.get(key)
+    if crc is not None:
+        _crc_cache.move_to_end(key)
+    return crc
+
+
+def remember_crc(path: str, size: int, mtime: float, crc: int):
+    _crc_cache[(path, size, mtime)] = crc
+    _crc_cache.move_to_end((path, size, mtime))
+    while len(_crc_cache) > CRC_CACHE_SIZE:
+        _crc_cache.popitem(last=False)
+
+
+class ZipEntry:
+    """
+    Файл архива: путь на диске или данные в памяти.
+    crc — заранее известная CRC-32 файла; без неё диапазоны после файла
+    требуют его прочитать.
+    stored_crc — CRC, известная при создании (из БД или по данным в памяти);
+    в отличие от crc не меняется после отдачи файла.
+    """
+
+    def __init__(self, name: str, size: int, mtime: float,
+                 path: Optional[str] = None, data: Optional[bytes] = None,
+                 crc: Optional[int] = None):
+        self.name = name
+        self.encoded_name = name.encode("utf-8")
+        self.size = size
+        self.mtime = mtime
+        self.path = path
+        self.data = data
+        if data is not None:
+            crc = zlib.crc32(data)
+        self.stored_crc = crc
+        if crc is None:
+            crc = cached_crc(path, size, mtime)
+        self.crc = crc
+        self.offset = 0
+
+    @property
+    def header_size(self) -> int:
+        return LOCAL_HEADER_SIZE + len(self.encoded_name) + LOCAL_ZIP64_EXTRA_SIZE
+
+    @property
+    def total_size(self) -> int:
+        return self.header_size + self.size + DESCRIPTOR_SIZE
+
+
+def dos_datetime(timestamp: float) -> Tuple[int, int]:
+    """Время в формате MS-DOS (UTC, не раньше 1980 года)"""
+    t = time.gmtime(max(timestamp, 315532800))
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+# ===== Потоковый архив =====
+
+
+class ZipStream:
+    """
+    ZIP64-архив без сжатия (STORED), собираемый на лету.
+    Размер и содержимое детерминированы по списку файлов,
+    поэтому архив можно отдавать по частям (Range) без временных файлов.
+    """
+
+    def __init__(self, entries: List[ZipEntry]):
+        self.entries = entries
+        offset = 0
+        for entry in entries:
+            entry.offset = offset
+            offset += entry.total_size
+        self.central_directory_offset = offset
+        self.central_directory_size = sum(
+            CENTRAL_HEADER_SIZE + len(entry.encoded_name) + CENTRAL_ZIP64_EXTRA_SIZE
+            for entry in entries)
+        self.size = offset + self.central_directory_size + END_RECORDS_SIZE
+
+    @property
+    def etag(self) -> str:
+        """
+        ETag архива: меняется при изменении любого файла.
+        Строится только из неизменных во времени значений: CRC, посчитанная
+        при отдаче или взятая из кэша, сменила бы ETag и сломала If-Range.
+        """
+        digest = hashlib.sha1()
+        for entry in self.entries:
+            digest.update(entry.encoded_name)
+            digest.update(struct.pack("<Qd", entry.size, entry.mtime))
+            if entry.stored_crc is not None:
+                digest.update(struct.pack("<I", entry.stored_crc))
+        return f'"{digest.hexdigest()}"'
+
+    def _local_header(self, entry: ZipEntry) -> bytes:
+        dos_time, dos_date = dos_datetime(entry.mtime)
+        return struct.pack(
+            "<IHHHHHIIIHH", 0x04034b50, ZIP_VERSION, FLAGS, 0, dos_time, dos_date,
+            0, UINT32_MAX, UINT32_MAX, len(entry.encoded_name), LOCAL_ZIP64_EXTRA_SIZE,
+        ) + entry.encoded_name + struct.pack("<HHQQ", 0x0001, 16, 0, 0)
+
+    def _descriptor(self, entry: ZipEntry) -> bytes:
+        return struct.pack("<IIQQ", 0x08074b50, entry.crc, entry.size, entry.size)
+
+    def _central_directory(self) -> bytes:
+        records = []
+        for entry in self.entries:
+            dos_time, dos_date = dos_datetime(entry.mtime)
+            records.append(struct.pack(
+                "<IHHHHHHIIIHHHHHII", 0x02014b50, MADE_BY_UNIX, ZIP_VERSION, FLAGS, 0,
+                dos_time, dos_date, entry.crc, UINT32_MAX, UINT32_MAX,
+                len(entry.encoded_name), CENTRAL_ZIP64_EXTRA_SIZE, 0, 0, 0,
+                FILE_ATTRIBUTES, UINT32_MAX,
+            ) + entry.encoded_name + struct.pack(
+                "<HHQQQ", 0x0001, 24, entry.size, entry.size, entry.offset))
+        return b"".join(records)
+
+    def _end_records(self) -> bytes:
+        zip64_end_offset = self.central_directory_offset + self.central_directory_size
+        count = len(self.entries)
+        return struct.pack(
+            "<IQHHIIQQQQ", 0x06064b50, 44, ZIP_VERSION, ZIP_VERSION, 0, 0,
+            count, count, self.central_directory_size, self.central_directory_offset,
+        ) + struct.pack(
+            "<IIQI", 0x07064b50, 0, zip64_end_offset, 1,
+        ) + struct.pack(
+            "<IHHHHIIH", 0x06054b50, 0, 0, UINT16_MAX, UINT16_MAX, UINT32_MAX, UINT32_MAX, 0,
+        )
+
+    async def _entry_data(self, entry: ZipEntry, offset: int = 0) -> AsyncIterator[bytes]:
+        """
+        Данные файла по кускам начиная с offset.
+        При чтении с начала попутно считает (или сверяет) CRC.
+        """
+        if entry.data is not None:
+            yield entry.data[offset:]
+            return
+        crc = 0
+        read = offset
+        async with aiofiles.open(entry.path, "rb") as f:
+            if offset:
+                await f.seek(offset)
+            while read < entry.size:
+                chunk = await f.read(min(CHUNK_SIZE, entry.size - read))
+                if not chunk:
+                    break
+                if not offset:
+                    crc = zlib.crc32(chunk, crc)
+                read += len(chunk)
+                yield chunk
+        if read != entry.size:
+            raise IOError(f"Файл изменился во время экспорта: {entry.path}")
+        if offset:
+            return
+        if entry.crc is not None and entry.crc != crc:
+            raise IOError(f"Файл изменился во время экспорта: {entry.path}")
+        entry.crc = crc
+        remember_crc(entry.path, entry.size, entry.mtime, crc)
+
+    async def iter_bytes(self, start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+        """Байты архива в диапазоне [start, end] включительно"""
+        end = self.size - 1 if end is None else end
+        # Центральному каталогу нужны CRC всех файлов, даже не попавших в диапазон
+        need_all_crcs = end >= self.central_directory_offset
+        position = 0
+
+        def window(data: bytes) -> bytes:
+            nonlocal position
+            chunk_start = position
+            position += len(data)
+            return data[max(start - chunk_start, 0):max(end + 1 - chunk_start, 0)]
+
+        for entry in self.entries:
+            if position > end:
+                return
+            entry_end = position + entry.total_size
+            if entry_end <= start and (entry.crc is not None or not need_all_crcs):
+                position = entry_end
+                continue
+
+            chunk = window(self._local_header(entry))
+            if chunk:
+                yield chunk
+            # С известной CRC начало файла до диапазона можно не читать
+            skip = min(max(start - position, 0), entry.size) if entry.crc is not None else 0
+            position += skip
+            async for data in self._entry_data(entry, skip):
+                chunk = window(data)
+                if chunk:
+                    yield chunk
+            chunk = window(self._descriptor(entry))
+            if chunk:
+                yield chunk
+
+        if position > end:
+            return
+        chunk = window(self._central_directory() + self._end_records())
+        if chunk:
+            yield chunk
+
+
+def parse_byte_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Разбор заголовка Range (один диапазон).
+    Возвращает (start, end) включительно; ValueError — диапазон невыполним.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    if not first:
+        if not last:
+            return None
+        length = int(last)
+        if length == 0:
+            raise ValueError("Пустой диапазон")
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError("Диапазон вне файла")
+    return start, min(end, size - 1)